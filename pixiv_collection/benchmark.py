@@ -0,0 +1,468 @@
+'''PixivCollection 性能基准
+
+生成包含多种格式与颜色模式的合成图库, 使用模拟延迟与错误的 AppPixivAPI,
+在不同规模下计时 diff, update, generate_preview, generate_thumbnail, save_data, export,
+并对 ColorThief 做微基准测试; 结果输出为 JSON, 可与其他提交的结果比较:
+
+    python benchmark.py --scales 1000,10000,100000 --output bench.json
+    python benchmark.py --scales 1000 --compare bench.json
+
+合成图库按 (数量, 随机种子, 尺寸) 缓存在工作目录中, 重复运行时复用
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # 仅 POSIX 系统提供, Windows 下不记录峰值内存
+    resource = None
+
+import numpy as np
+from loguru import logger
+from PIL import Image, ImageDraw
+
+import collection
+from collection import PixivCollection
+from colorthief import MMCQ, ColorThief, NumpyMMCQ, get_palettes
+
+BENCH_SCALES = (1000, 10000, 100000)
+BENCH_DIR = './benchmark/'
+# (扩展名, 颜色模式, 权重), 大致接近 Pixiv 原图的构成
+CORPUS_FORMATS = (
+    ('jpg', 'RGB', 45),
+    ('png', 'RGB', 15),
+    ('png', 'RGBA', 15),
+    ('png', 'P', 10),
+    ('png', 'PA', 5),
+    ('png', 'L', 5),
+    ('png', 'LA', 3),
+    ('gif', 'P', 2),
+)
+MAX_PARTS = 4
+FIRST_ILLUST_ID = 10000000
+TAG_POOL = 2000
+MICRO_SIZES = ((80, 80), (500, 500), (2000, 2000))
+MICRO_MODES = ('RGB', 'RGBA', 'P', 'L')
+
+
+class FakeAppPixivAPI():
+    '''模拟 AppPixivAPI, 每次请求等待 latency 秒(上下浮动 jitter 比例)
+
+    按 error_rate 抛出连接错误, 按 throttle_rate 返回限流错误, 作品信息由 ID 确定性生成
+    '''
+
+    def __init__(self,
+                 latency: float = 0.02,
+                 jitter: float = 0.5,
+                 error_rate: float = 0.01,
+                 throttle_rate: float = 0.01,
+                 authors: int = 500,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.authors = authors
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def auth(self, **kwargs):
+        return {'access_token': 'benchmark'}
+
+    def set_accept_language(self, language: str):
+        pass
+
+    def __request(self):
+        '''模拟一次请求, 返回 None 表示正常, 否则为错误响应'''
+        with self.__lock:
+            self.calls += 1
+            r = self.__random.random()
+            delay = self.latency * (1 + self.jitter *
+                                    (2 * self.__random.random() - 1))
+            if r < self.error_rate:
+                self.errors += 1
+            elif r < self.error_rate + self.throttle_rate:
+                self.throttles += 1
+        time.sleep(max(0, delay))
+        if r < self.error_rate:
+            raise ConnectionError('simulated connection reset')
+        if r < self.error_rate + self.throttle_rate:
+            return {
+                'error': {
+                    'message': 'Rate Limit',
+                    'user_message': '',
+                }
+            }
+        return None
+
+    def user(self, user_id: int):
+        return {
+            'id': user_id,
+            'name': f'user{user_id}',
+            'account': f'account{user_id}',
+        }
+
+    def illust(self, illust_id: int):
+        rng = random.Random(illust_id)
+        tags = rng.sample(range(TAG_POOL), rng.randint(1, 10))
+        return {
+            'id': illust_id,
+            'title': f'illust{illust_id}',
+            'caption': '',
+            'user': self.user(illust_id % self.authors + 1),
+            'tags': [{
+                'name': f'tag{tag}',
+                'translated_name': None
+            } for tag in tags],
+            'create_date': '2023-06-01T00:00:00+09:00',
+            'sanity_level': rng.choice((2, 4, 6)),
+            'x_restrict': rng.choice((0, 0, 0, 1)),
+            'total_bookmarks': rng.randint(0, 50000),
+            'total_view': rng.randint(0, 500000),
+            'illust_ai_type': rng.choice((1, 1, 1, 2)),
+        }
+
+    def illust_detail(self, illust_id: int):
+        return self.__request() or {'illust': self.illust(int(illust_id))}
+
+    def user_detail(self, user_id: int):
+        return self.__request() or {'user': self.user(int(user_id))}
+
+
+def synthetic_image(rng: np.random.Generator, mode: str,
+                    size: tuple[int, int]):
+    '''生成渐变背景加随机几何图形的图像, 内容平滑, PNG 压缩率接近插画'''
+    width, height = size
+    start, end = rng.integers(0, 256, (2, 3))
+    t = np.linspace(0, 1, width)[None, :, None] * rng.random() + np.linspace(
+        0, 1, height)[:, None, None] * (1 - rng.random())
+    t = t / max(t.max(), 1e-6)
+    pixels = (start + (end - start) * t).astype(np.uint8)
+    img = Image.fromarray(np.ascontiguousarray(pixels), 'RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(int(rng.integers(3, 12))):
+        x0, x1 = sorted(rng.integers(0, width, 2))
+        y0, y1 = sorted(rng.integers(0, height, 2))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+        else:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+    if mode in ('RGBA', 'LA', 'PA'):
+        alpha = np.linspace(0, 255, width, dtype=np.uint8)[None, :].repeat(
+            height, axis=0)
+        img.putalpha(Image.fromarray(alpha, 'L'))
+    if mode == 'P':
+        return img.quantize(int(rng.integers(16, 257)))
+    if mode == 'PA':
+        return img.quantize(int(rng.integers(16, 256)),
+                            method=Image.Quantize.FASTOCTREE)
+    if mode == 'LA':
+        return img.convert('LA')
+    if mode == 'L':
+        return img.convert('L')
+    return img
+
+
+def generate_corpus(path: str,
+                    count: int,
+                    seed: int = 0,
+                    min_side: int = 200,
+                    max_side: int = 1600):
+    '''在 path/original 下生成 count 个原图, 每个作品 1~MAX_PARTS 个分P, 返回原图目录
+
+    path/corpus.json 记录生成参数, 参数一致时直接复用
+    '''
+    original = os.path.join(path, 'original/')
+    manifest = os.path.join(path, 'corpus.json')
+    config = {
+        'count': count,
+        'seed': seed,
+        'min_side': min_side,
+        'max_side': max_side,
+        'formats': CORPUS_FORMATS,
+    }
+    if os.path.exists(manifest):
+        with open(manifest, 'r', encoding='utf-8') as f:
+            if json.load(f) == json.loads(json.dumps(config)):
+                return original
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(original)
+    rng = np.random.default_rng(seed)
+    weights = np.array([w for _, _, w in CORPUS_FORMATS], dtype=float)
+    illust_id = FIRST_ILLUST_ID
+    written = 0
+    start = time.perf_counter()
+    while written < count:
+        parts = min(int(rng.integers(1, MAX_PARTS + 1)), count - written)
+        for part in range(parts):
+            ext, mode, _ = CORPUS_FORMATS[rng.choice(len(CORPUS_FORMATS),
+                                                     p=weights /
+                                                     weights.sum())]
+            size = tuple(int(s) for s in rng.integers(min_side, max_side, 2))
+            img = synthetic_image(rng, mode, size)
+            file_path = f'{original}{illust_id}_p{part}.{ext}'
+            if ext == 'jpg':
+                img.save(file_path, 'JPEG', quality=int(rng.integers(80, 96)))
+            elif ext == 'gif':
+                img.save(file_path, 'GIF')
+            else:
+                img.save(file_path, 'PNG', compress_level=1)
+            written += 1
+        illust_id += int(rng.integers(1, 50))
+        if written % 1000 < parts:
+            logger.info(f'生成合成图库: {written}/{count} '
+                        f'{time.perf_counter() - start:.1f}s')
+    with open(manifest, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    return original
+
+
+def setup_logger(level: str):
+    '''PixivCollection 初始化时会重置日志输出, 之后调用以设置基准测试的日志级别'''
+    logger.remove()
+    logger.add(lambda message: print(message, end=''),
+               level=level,
+               format=collection.LOG_FORMAT)
+
+
+def max_rss_mb():
+    '''进程峰值常驻内存(MB), 单调不减; 无法获取时返回 None'''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / (1024 * 1024 if platform.system() == 'Darwin' else
+                          1024), 1)
+
+
+@contextmanager
+def timed(results: dict, name: str, items: int):
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    results[name] = {
+        'seconds': round(seconds, 4),
+        'items': items,
+        'ms_per_item': round(seconds * 1000 / max(items, 1), 4),
+    }
+    logger.info(f'{name}: {seconds:.2f}s ({items} 项)')
+
+
+def bench_scale(corpus: str, workdir: str, args):
+    '''在 workdir 中从空数据开始处理合成图库, 返回各步骤计时'''
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir + 'preview/')
+    os.makedirs(workdir + 'thumbnail/')
+    data_path = workdir + ('collection.db'
+                           if args.storage == 'sqlite' else 'collection.json')
+    if args.storage == 'json':
+        with open(data_path, 'w', encoding='utf-8') as f:
+            json.dump({'authors': {}, 'images': {}, 'tags': {}, 'files': {}},
+                      f)
+
+    api = FakeAppPixivAPI(args.latency, args.jitter, args.error_rate,
+                          args.throttle_rate, seed=args.seed)
+    collection.AppPixivAPI = lambda: api
+    c = PixivCollection()
+    setup_logger(args.log_level)
+    c.set_path({
+        'original': corpus,
+        'preview': workdir + 'preview/',
+        'thumbnail': workdir + 'thumbnail/',
+    })
+    c.init(refresh_token='benchmark')
+    c.set_rate_limit(args.rate, args.api_workers)
+    if args.storage == 'json':
+        c.read_data(data_path)
+
+    results = {}
+    files = len(os.listdir(corpus))
+    with timed(results, 'diff', files):
+        c.diff(conflict_policy=('duplicate', 'lossless', 'largest'))
+    with timed(results, 'diff_noop', files):
+        c.diff()
+    illusts = len({filename.split('_')[0] for filename in c.files})
+    with timed(results, 'update', illusts):
+        c.update(workers=args.api_workers, max_rate=args.rate)
+    with timed(results, 'generate_preview', files):
+        c.generate_preview(workers=args.workers)
+    with timed(results, 'generate_thumbnail', files):
+        c.generate_thumbnail(workers=args.workers)
+    with timed(results, 'save_data', files):
+        c.save_data(data_path)
+    with timed(results, 'save_data_noop', files):
+        c.save_data(data_path)
+    with timed(results, 'export', files):
+        c.export(workdir + 'images.json')
+    results['api'] = {
+        'calls': api.calls,
+        'errors': api.errors,
+        'throttles': api.throttles,
+    }
+    results['metrics'] = c.metrics().summary()
+    results['max_rss_mb'] = max_rss_mb()
+    return results
+
+
+def bench_colorthief(repeat: int, seed: int = 0):
+    '''ColorThief 微基准: 各尺寸与颜色模式下 get_color 的耗时, 以及 get_palettes 批量计算
+
+    纯 Python 引擎只测试 quality=10, 结果为 repeat 次中的最小值与中位数(毫秒)
+    '''
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    def measure(name, func):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = {
+            'min_ms': round(min(samples), 4),
+            'median_ms': round(statistics.median(samples), 4),
+        }
+
+    for size in MICRO_SIZES:
+        for mode in MICRO_MODES:
+            img = synthetic_image(rng, mode, size)
+            label = f'{size[0]}x{size[1]}.{mode}'
+            for engine, qualities in ((NumpyMMCQ, (1, 10)), (MMCQ, (10, ))):
+                for quality in qualities:
+                    measure(
+                        f'get_color.{engine.__name__}.q{quality}.{label}',
+                        lambda: ColorThief(img, engine).get_color(quality))
+    images = [
+        synthetic_image(rng, 'RGB', (80, 80)).convert('RGBA')
+        for _ in range(256)
+    ]
+    measure('get_palettes.NumpyMMCQ.q1.batch256',
+            lambda: get_palettes(images, 5, 1))
+    measure('get_palette.NumpyMMCQ.q1.loop256',
+            lambda: [ColorThief(img).get_palette(5, 1) for img in images])
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: dict, prefix: str = ''):
+    '''展开为 {路径: 数值}, 用于比较'''
+    flat = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)):
+            flat[path] = value
+    return flat
+
+
+def compare(current: dict, baseline: dict):
+    '''输出耗时类指标相对 baseline 的比值, 大于 1 表示变慢'''
+    new = flatten(current['results'])
+    old = flatten(baseline['results'])
+    print(f'对比 {baseline.get("commit")} -> {current.get("commit")}')
+    for key in new:
+        if key in old and key.endswith(('seconds', 'min_ms')) and old[key]:
+            ratio = new[key] / old[key]
+            mark = ' !' if ratio > 1.1 else ''
+            print(f'{key:<60} {old[key]:>12.4f} {new[key]:>12.4f} '
+                  f'{ratio:>7.2f}x{mark}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PixivCollection 性能基准')
+    parser.add_argument('--scales',
+                        default=','.join(str(s) for s in BENCH_SCALES),
+                        help='图库规模, 逗号分隔')
+    parser.add_argument('--dir', default=BENCH_DIR, help='工作目录')
+    parser.add_argument('--output', default=None, help='结果 JSON 文件')
+    parser.add_argument('--compare', default=None, help='与之前的结果 JSON 比较')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-side', type=int, default=200)
+    parser.add_argument('--max-side', type=int, default=1600)
+    parser.add_argument('--storage', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='生成预览图与缩略图的进程数')
+    parser.add_argument('--api-workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=200, help='API 速率上限')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--throttle-rate', type=float, default=0.01)
+    parser.add_argument('--retry-wait',
+                        type=float,
+                        default=0.05,
+                        help='模拟环境中的重试等待基数(秒)')
+    parser.add_argument('--repeat', type=int, default=20, help='微基准重复次数')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--log-level',
+                        default='CRITICAL',
+                        help='各步骤运行时的日志级别, 模拟的请求错误会输出 ERROR 日志')
+    args = parser.parse_args()
+
+    # 重试等待以 WAIT_TIME 为基数, 模拟错误时缩短以免掩盖其他步骤的耗时
+    collection.WAIT_TIME = args.retry_wait
+    setup_logger('INFO')
+    report = {
+        'commit': git_commit(),
+        'created_at': int(time.time()),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pillow': Image.__version__,
+        },
+        'config': vars(args),
+        'results': {},
+    }
+    if not args.skip_micro:
+        logger.info('ColorThief 微基准')
+        report['results']['colorthief'] = bench_colorthief(
+            args.repeat, args.seed)
+    for scale in (int(s) for s in args.scales.split(',') if s):
+        corpus = generate_corpus(f'{args.dir}corpus-{scale}/', scale,
+                                 args.seed, args.min_side, args.max_side)
+        logger.info(f'规模 {scale}')
+        report['results'][f'scale.{scale}'] = bench_scale(
+            corpus, f'{args.dir}run-{scale}/', args)
+        setup_logger('INFO')
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        logger.info(f'结果已保存至 {args.output}')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+class Cache(ABC):
+    '''缓存接口, 支持条目过期时间、数量上限(LRU 淘汰)与命中统计
+
+    ttl 为默认过期秒数, None 表示不过期; max_entries 为 None 表示不限制数量
+    '''
+
+    def __init__(self, ttl: float | None = None, max_entries: int | None = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expire_at(self, ttl: float | None):
+        ttl = self.ttl if ttl is None else ttl
+        return None if ttl is None else time.time() + ttl
+
+    @abstractmethod
+    def get(self, key: str):
+        '''读取缓存, 不存在或已过期返回 None'''
+
+    @abstractmethod
+    def set(self, key: str, value, ttl: float | None = None):
+        '''写入缓存, ttl 为 None 时使用默认过期时间'''
+
+    @abstractmethod
+    def delete(self, key: str):
+        '''删除缓存'''
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class MemoryCache(Cache):
+    '''进程内缓存'''
+
+    def __init__(self, ttl: float | None = None, max_entries: int | None = None):
+        super().__init__(ttl, max_entries)
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is None or (item[1] is not None and item[1] < time.time()):
+                if item is not None:
+                    del self.__data[key]
+                self.misses += 1
+                return None
+            self.__data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: str, value, ttl: float | None = None):
+        with self.__lock:
+            self.__data[key] = (value, self._expire_at(ttl))
+            self.__data.move_to_end(key)
+            while self.max_entries is not None and len(
+                    self.__data) > self.max_entries:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self.__lock:
+            self.__data.pop(key, None)
+
+
+class SQLiteCache(Cache):
+    '''SQLite 持久化缓存, 值以 JSON 保存'''
+
+    def __init__(self,
+                 file_path: str,
+                 ttl: float | None = None,
+                 max_entries: int | None = None):
+        super().__init__(ttl, max_entries)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(file_path, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expire REAL,
+                access REAL NOT NULL)''')
+        self.__db.execute(
+            'CREATE INDEX IF NOT EXISTS cache_access ON cache (access)')
+        self.__db.commit()
+
+    def get(self, key: str):
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT value, expire FROM cache WHERE key = ?',
+                (key, )).fetchone()
+            now = time.time()
+            if row is None or (row[1] is not None and row[1] < now):
+                if row is not None:
+                    self.__db.execute('DELETE FROM cache WHERE key = ?',
+                                      (key, ))
+                    self.__db.commit()
+                self.misses += 1
+                return None
+            self.__db.execute('UPDATE cache SET access = ? WHERE key = ?',
+                              (now, key))
+            self.__db.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float | None = None):
+        with self.__lock:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False),
+                 self._expire_at(ttl), time.time()))
+            if self.max_entries is not None:
+                count = self.__db.execute(
+                    'SELECT COUNT(*) FROM cache').fetchone()[0]
+                if count > self.max_entries:
+                    self.__db.execute(
+                        'DELETE FROM cache WHERE key IN '
+                        '(SELECT key FROM cache ORDER BY access LIMIT ?)',
+                        (count - self.max_entries, ))
+                    self.evictions += count - self.max_entries
+            self.__db.commit()
+
+    def delete(self, key: str):
+        with self.__lock:
+            self.__db.execute('DELETE FROM cache WHERE key = ?', (key, ))
+            self.__db.commit()
+
+    def purge(self):
+        '''删除已过期条目'''
+        with self.__lock:
+            self.__db.execute(
+                'DELETE FROM cache WHERE expire IS NOT NULL AND expire < ?',
+                (time.time(), ))
+            self.__db.commit()
+
+    def close(self):
+        self.__db.close()
@@ -1,15 +1,41 @@
+import hashlib
 import json
 import os
 import sys
+import threading
 import time
 import re
+from collections import deque
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed)
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from io import StringIO
 
 from loguru import logger
 from pixivpy3 import AppPixivAPI
 from PIL import Image
 
-from colorthief import ColorThief
+from cache import Cache, MemoryCache
+from colorthief import ColorThief, get_palettes
+from decoder import decode_image, verify_image
+from dedup import (DEFAULT_POLICY, PHASH_RADIUS, dhash, group_by,
+                   narrow_candidates)
+from downloader import PART_SUFFIX, fetch_resumable
+from exporter import (DELTA_COMPACT_EVERY, export_order, iter_records,
+                      write_delta_export, write_export)
+from index import CollectionIndex
+from journal import (JOURNAL_CHECKPOINT_EVERY, JOURNAL_FLUSH_EVERY, Journal,
+                     journal_path)
+from metrics import Metrics
+from placeholder import (PLACEHOLDER_SIZE, blurhash_encode,
+                         blurhash_encode_batch)
+from ratelimit import AIMDLimiter, TokenBucket, backoff, is_rate_limited
+from scheduler import (BOOKMARK_PAGE_MIN_HITS, REFRESH_MIN_INTERVAL,
+                       RefreshScheduler, estimate_rate)
+from scanner import file_hash, file_stat, record_stat, scan_files
+from storage import open_storage
+from watcher import WATCH_DEBOUNCE, WATCH_POLL_INTERVAL, DirectoryWatcher
 
 MAX_RETRY = 3
 WAIT_TIME = 1.5
@@ -17,6 +43,17 @@ PREVIEW_SIZE = (2000, 2000)
 THUMBNAIL_SIZE = (500, 1000)
 PREVIEW_QUALITY = 80
 THUMBNAIL_QUALITY = 70
+PARTIAL_DIR = '.download/'
+WATERMARK_SIZE = 30
+AIMD_MAX_RATE = 10
+WATCH_CONFLICT_POLICY = ('duplicate', 'lossless', 'largest', 'newest')
+PALETTE_SIZE = 5
+DATA_TABLES = {
+    'author': 'authors',
+    'image': 'images',
+    'tag': 'tags',
+    'file': 'files',
+}
 LOG_FORMAT = '<g>[{time:YYYY-MM-DD HH:mm:ss.SSS}]</g> <lvl>[{level}] {message}</lvl>'
 
 
@@ -35,6 +72,56 @@ def get_dominant_color(img: Image.Image):
     return rgb2hex(dominant_color)
 
 
+def convert_palette(palette):
+    '''ColorThief 带权重调色板转换为 [[#rrggbb, 占比]]'''
+    return [[rgb2hex(color), round(weight, 4)] for color, weight in palette]
+
+
+def get_color_info(img: Image.Image):
+    '''获取主色调、调色板与 BlurHash 占位图, 共用 ColorThief 缩小后的 80x80 图像
+
+    主色调即调色板的第一个颜色, 与 get_dominant_color 结果一致
+    '''
+    thief = ColorThief(img)
+    palette = convert_palette(
+        thief.get_weighted_palette(PALETTE_SIZE, quality=1))
+    return palette[0][0], palette, blurhash_encode(thief.image)
+
+
+def flatten_alpha(img: Image.Image):
+    '''将透明通道合成至白色背景'''
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new(img.mode[:-1], img.size, 'white')
+        background.paste(img, img.split()[-1])
+        img = background
+    if img.mode == 'P':
+        img = img.convert('RGB')
+    return img
+
+
+def render_webp(src: str,
+                dst: str,
+                size: tuple[int, int],
+                quality: int,
+                budget: int | None = None):
+    '''缩放图片并保存为 WebP, 为模块级函数以便在进程池中执行
+
+    返回 {'decode': 解码与缩放耗时, 'encode': 编码耗时, 'bytes': 写入字节数}, 由主进程记录指标
+    '''
+    start = time.perf_counter()
+    _, img = decode_image(src, size, budget)
+    img.thumbnail(size)
+    img = flatten_alpha(img)
+    decoded = time.perf_counter()
+    img.save(dst, 'WEBP', quality=quality)
+    img.close()
+    return {
+        'decode': decoded - start,
+        'encode': time.perf_counter() - decoded,
+        'bytes': os.path.getsize(dst),
+    }
+
+
 def normalize_filename(filename):
     pattern = r'^(\d+)(?:-[^_]+)?(_p\d+\.\w+)$'
     match = re.match(pattern, filename)
@@ -49,7 +136,12 @@ class PixivCollection():
         logger.remove(handler_id=None)
         logger.add(sys.stdout, level='INFO', format=LOG_FORMAT)
         self.__api = None
-        self.__cache = {}
+        self.__api_calls = 0
+        self.__api_lock = threading.Lock()
+        self.__cache = MemoryCache()
+        self.__limiter = TokenBucket(1 / WAIT_TIME)
+        self.__pixel_budget = None
+        self.__metrics = Metrics()
         self.__path = {
             'original': './image/original/',
             'preview': './image/preview/',
@@ -59,24 +151,59 @@ class PixivCollection():
         self.images = {}
         self.tags = {}
         self.files = {}
+        self.watermarks = {}
+        self.__storage = None
+        self.__dirty = {type: set() for type in DATA_TABLES}
+        self.__index = CollectionIndex()
+        self.__revision = 0
+        self.__changes = {type: {} for type in DATA_TABLES}
+        self.__fingerprints = {}
+        self.__journal = None
+        self.__journal_options = {
+            'flush_every': JOURNAL_FLUSH_EVERY,
+            'checkpoint_every': JOURNAL_CHECKPOINT_EVERY,
+        }
 
     def __list_files(self, path):
         files = os.listdir(path)
         return [f for f in files if os.path.isfile(os.path.join(path, f))]
 
-    def __get_illust_info(self, illust_id: int | str):
-        '''API 获取插画信息'''
+    def __get_illust_info(self,
+                          illust_id: int | str,
+                          use_cache=True,
+                          limiter: TokenBucket | None = None,
+                          max_retry: int = MAX_RETRY):
+        '''API 获取插画信息, use_cache 为 False 时忽略缓存重新获取
 
+        limiter 为本次请求使用的限速器, 默认为共用的限速器; 被限流时通知限速器并退避重试,
+        被限流或出错时最多重试 max_retry 次
+        '''
+
+        limiter = limiter or self.__limiter
         illust_id = int(illust_id)
-        if self.__cache.get(f'illust_info_{illust_id}'):
-            return self.__cache[f'illust_info_{illust_id}']
+        cached = None
+        if use_cache:
+            cached = self.__cache.get(f'illust_info_{illust_id}')
+            self.__metrics.inc('cache',
+                               kind='illust',
+                               result='hit' if cached else 'miss')
+        if cached:
+            return cached
         result = {}
         retry = 0
         success = False
-        while not success and retry <= MAX_RETRY:
+        while not success and retry <= max_retry:
             try:
-                result = self.__api.illust_detail(illust_id)
+                result = self.__call_api('illust_detail', limiter,
+                                         self.__api.illust_detail, illust_id)
                 logger.debug(json.dumps(result))
+                if is_rate_limited(result):
+                    limiter.throttled()
+                    retry += 1
+                    if retry <= max_retry:
+                        logger.warning(f'获取插画{illust_id}信息被限流,重试第{retry}次')
+                        self.__backoff('illust_detail', retry)
+                    continue
                 if result.get('error', None):
                     logger.warning(
                         f'获取插画{illust_id}信息失败,原因: {result["error"]["user_message"]}'
@@ -84,30 +211,44 @@ class PixivCollection():
                     return None
                 if result.get('illust', None):
                     success = True
+                    limiter.success()
             except Exception as e:
                 retry += 1
                 logger.exception(e)
-                if retry <= MAX_RETRY:
+                if retry <= max_retry:
                     logger.error(f'获取插画{illust_id}信息失败,重试第{retry}次')
-                time.sleep(WAIT_TIME)
+                    self.__backoff('illust_detail', retry)
         if not success:
             return None
         # 缓存插画信息
-        self.__cache[f'illust_info_{illust_id}'] = result
-        time.sleep(WAIT_TIME)
+        self.__cache.set(f'illust_info_{illust_id}', result)
         return result
 
     def __get_user_info(self, user_id: int | str):
         '''API 获取用户信息'''
 
         user_id = int(user_id)
+        cached = self.__cache.get(f'user_info_{user_id}')
+        self.__metrics.inc('cache',
+                           kind='user',
+                           result='hit' if cached else 'miss')
+        if cached:
+            return cached
         result = {}
         retry = 0
         success = False
         while not success and retry <= MAX_RETRY:
             try:
-                result = self.__api.user_detail(user_id)
+                result = self.__call_api('user_detail', self.__limiter,
+                                         self.__api.user_detail, user_id)
                 logger.debug(json.dumps(result))
+                if is_rate_limited(result):
+                    self.__limiter.throttled()
+                    retry += 1
+                    if retry <= MAX_RETRY:
+                        logger.warning(f'获取用户{user_id}信息被限流,重试第{retry}次')
+                        self.__backoff('user_detail', retry)
+                    continue
                 if result.get('error', None):
                     logger.info(
                         f'获取用户{user_id}信息失败,原因: {result["error"]["user_message"]}'
@@ -115,101 +256,253 @@ class PixivCollection():
                     return None
                 if result.get('user', None):
                     success = True
+                    self.__limiter.success()
             except Exception as e:
                 retry += 1
                 logger.exception(e)
                 if retry <= MAX_RETRY:
                     logger.error(f'获取用户{user_id}信息失败,重试第{retry}次')
-                time.sleep(WAIT_TIME)
+                    self.__backoff('user_detail', retry)
         if not success:
             return None
-        time.sleep(WAIT_TIME)
+        # 缓存用户信息
+        self.__cache.set(f'user_info_{user_id}', result)
+        return result
+
+    def __call_api(self, endpoint: str, limiter: TokenBucket, func, *args,
+                   **kwargs):
+        '''经限速器调用 API, 分别记录等待限速器与请求本身的耗时, 以及请求结果'''
+
+        with self.__metrics.timer('rate_limit_wait', endpoint=endpoint):
+            limiter.acquire()
+        with self.__api_lock:
+            self.__api_calls += 1
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.__metrics.inc('api_requests',
+                               endpoint=endpoint,
+                               result='exception')
+            raise
+        finally:
+            self.__metrics.observe('api_request',
+                                   time.perf_counter() - start,
+                                   endpoint=endpoint)
+        self.__metrics.inc(
+            'api_requests',
+            endpoint=endpoint,
+            result='throttled' if isinstance(result, dict)
+            and is_rate_limited(result) else 'error' if isinstance(
+                result, dict) and result.get('error') else 'ok')
         return result
 
+    def __backoff(self, endpoint: str, retry: int):
+        '''重试前退避等待, 记录重试次数与等待时间'''
+
+        wait = backoff(retry, WAIT_TIME)
+        self.__metrics.inc('retries', endpoint=endpoint)
+        self.__metrics.inc('backoff_seconds', wait, endpoint=endpoint)
+        time.sleep(wait)
+
     def __get_file_info(self, filename: str):
         '''获取图片文件信息'''
 
+        return self.__process_original(filename)
+
+    def __process_original(self,
+                           filename: str,
+                           preview_size: tuple[int, int] | None = None,
+                           thumbnail_size: tuple[int, int] | None = None):
+        '''单次解码原图, 生成文件信息、主色调、内容哈希、感知哈希以及预览图和缩略图
+
+        缩略图由预览图缩小得到, 传入 None 则不生成对应图片
+        '''
+
         file_path = self.__path['original'] + filename
         image_id = int(filename.split('_')[0])
         part = int(filename.split('.')[0].split('p')[1])
         ext = filename.split('.')[-1]
-        image_obj = Image.open(file_path)
-        size = image_obj.size
-        dominant_color = get_dominant_color(image_obj)
-        image_obj.close()
-        filesize = os.path.getsize(file_path)
-        return {
+        with self.__metrics.timer('decode', kind='original'):
+            size, img = decode_image(file_path, PREVIEW_SIZE,
+                                     self.__pixel_budget)
+        with self.__metrics.timer('analyze'):
+            dominant_color, palette, blurhash = get_color_info(img)
+            phash = dhash(img)
+        if preview_size or thumbnail_size:
+            img = flatten_alpha(img)
+            img.thumbnail(preview_size or PREVIEW_SIZE)
+            if preview_size:
+                self.__save_webp(
+                    img, 'preview',
+                    f'{self.__path["preview"]}{image_id}_p{part}.webp',
+                    PREVIEW_QUALITY)
+            if thumbnail_size:
+                img.thumbnail(thumbnail_size)
+                self.__save_webp(
+                    img, 'thumbnail',
+                    f'{self.__path["thumbnail"]}{image_id}_p{part}.webp',
+                    THUMBNAIL_QUALITY)
+        img.close()
+        filesize, mtime_ns, inode = file_stat(file_path)
+        file_info = {
             'id': image_id,
             'part': part,
             'size': size,
             'ext': ext,
             'dominant_color': dominant_color,
+            'palette': palette,
+            'blurhash': blurhash,
             'filesize': filesize,
+            'mtime_ns': mtime_ns,
+            'inode': inode,
+            'hash': file_hash(file_path),
+            'phash': phash,
         }
+        return file_info
+
+    def __save_webp(self, img: Image.Image, kind: str, dst: str,
+                    quality: int):
+        with self.__metrics.timer('encode', kind=kind):
+            img.save(dst, 'WEBP', quality=quality)
+        self.__metrics.inc('bytes_written', os.path.getsize(dst), kind=kind)
+
+    def __partial_path(self, filename: str):
+        '''未完成下载的临时文件路径, 位于原图目录下的隐藏目录中以便原子重命名'''
+
+        partial_dir = self.__path['original'] + PARTIAL_DIR
+        os.makedirs(partial_dir, exist_ok=True)
+        return partial_dir + filename + PART_SUFFIX
 
     def __download_image(self, download_link: str):
-        '''下载图片'''
+        '''下载图片, 仅负责网络传输, 可在多个线程中同时执行
+
+        连接中断时保留已下载部分, 重试时通过 Range 请求续传
+        '''
 
         retry = 0
-        success = False
         filename = normalize_filename(download_link.split("/")[-1])
+        if os.path.exists(f'{self.__path["original"]}{filename}'):
+            return filename
+        part_path = self.__partial_path(filename)
         logger.info(f'下载图片: {download_link}')
-        while not success and retry <= 3:
+        while retry <= MAX_RETRY:
             try:
-                self.__api.download(download_link,
-                                    path=f'{self.__path["original"]}',
-                                    fname=filename)
-                # 检查图片完整性
-                img = Image.open(f'{self.__path["original"]}{filename}')
-                img.load()
-                img.close()
-                success = True
+                offset = os.path.getsize(part_path) if os.path.exists(
+                    part_path) else 0
+                size = self.__call_api('download', self.__limiter,
+                                       fetch_resumable,
+                                       self.__api.requests_call,
+                                       download_link, part_path)
+                self.__metrics.inc('download_bytes', max(0, size - offset))
+                return filename
             except Exception as e:
-                if os.path.exists(f'{self.__path["original"]}{filename}'):
-                    os.remove(f'{self.__path["original"]}{filename}')
                 logger.exception(e)
+                if os.path.exists(part_path):
+                    # 中断前已写入的部分
+                    self.__metrics.inc(
+                        'download_bytes',
+                        max(0,
+                            os.path.getsize(part_path) - offset))
                 retry += 1
-                if retry <= 3:
-                    logger.info(f'下载失败,重试第{retry}次')
-        return success
+                if retry <= MAX_RETRY:
+                    logger.info(f'下载失败,重试第{retry}次: {download_link}')
+                    self.__backoff('download', retry)
+        return None
 
-    def __generate_image_preview(self,
-                                 file: dict,
-                                 size: tuple[int, int] = PREVIEW_SIZE):
-        '''生成图片预览图'''
+    def __verify_image(self, filename: str):
+        '''检查图片完整性, 通过后原子重命名至原图目录, 损坏的文件会被删除'''
 
-        filename = f'{file["id"]}_p{file["part"]}.{file["ext"]}'
-        filename_preview = f'{file["id"]}_p{file["part"]}.webp'
-        img = Image.open(self.__path["original"] + filename)
-        img.thumbnail(size)
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new(img.mode[:-1], img.size, 'white')
-            background.paste(img, img.split()[-1])
-            img = background
-        if img.mode == 'P':
-            img = img.convert('RGB')
-        img.save(self.__path["preview"] + filename_preview,
-                 'WEBP',
-                 quality=PREVIEW_QUALITY)
-
-    def __generate_image_thumbnail(self,
-                                   file: dict,
-                                   size: tuple[int, int] = THUMBNAIL_SIZE):
-        '''生成图片缩略图'''
-
-        filename = f'{file["id"]}_p{file["part"]}.{file["ext"]}'
-        filename_thumbnail = f'{file["id"]}_p{file["part"]}.webp'
-        img = Image.open(self.__path["original"] + filename)
-        img.thumbnail(size)
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new(img.mode[:-1], img.size, 'white')
-            background.paste(img, img.split()[-1])
-            img = background
-        if img.mode == 'P':
-            img = img.convert('RGB')
-        img.save(self.__path["thumbnail"] + filename_thumbnail,
-                 'WEBP',
-                 quality=THUMBNAIL_QUALITY)
+        file_path = f'{self.__path["original"]}{filename}'
+        part_path = self.__partial_path(filename)
+        check_path = part_path if os.path.exists(part_path) else file_path
+        try:
+            with self.__metrics.timer('verify'):
+                verify_image(check_path, self.__pixel_budget)
+        except Exception as e:
+            logger.exception(e)
+            if os.path.exists(check_path):
+                os.remove(check_path)
+            return False
+        if check_path == part_path:
+            os.replace(part_path, file_path)
+        return True
+
+    def __download_images(self, download_list: list[str], workers: int = 1):
+        '''并发下载图片, 完整性检查在调用线程中进行, 检查失败的图片重新下载
+
+        返回下载失败的链接列表
+        '''
+
+        failed = []
+        attempts = {link: 0 for link in download_list}
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {
+                executor.submit(self.__download_image, link): link
+                for link in download_list
+            }
+            while futures:
+                future = next(as_completed(futures))
+                link = futures.pop(future)
+                filename = future.result()
+                if filename is not None and self.__verify_image(filename):
+                    continue
+                attempts[link] += 1
+                if filename is not None and attempts[link] <= MAX_RETRY:
+                    logger.info(f'图片校验失败,重新下载第{attempts[link]}次: {link}')
+                    futures[executor.submit(self.__download_image,
+                                            link)] = link
+                    continue
+                logger.error(f'下载失败: {link}, 多次重试失败, 跳过该图片')
+                failed.append(link)
+        return failed
+
+    def __file_hashes(self, filename: str):
+        '''获取文件的比较信息, 记录中的哈希在 stat 未变动时直接复用'''
+
+        file_path = self.__path['original'] + filename
+        stat = file_stat(file_path)
+        record = self.files.get(filename, {}).get('data', {})
+        if record_stat(record) == stat and record.get('hash') and record.get(
+                'phash'):
+            return {
+                'filename': filename,
+                'ext': record['ext'],
+                'size': record['size'],
+                'filesize': stat[0],
+                'mtime_ns': stat[1],
+                'hash': record['hash'],
+                'phash': record['phash'],
+            }
+        size, img = decode_image(file_path, PREVIEW_SIZE, self.__pixel_budget)
+        phash = dhash(img)
+        img.close()
+        return {
+            'filename': filename,
+            'ext': filename.split('.')[-1],
+            'size': size,
+            'filesize': stat[0],
+            'mtime_ns': stat[1],
+            'hash': file_hash(file_path),
+            'phash': phash,
+        }
+
+    def __select_conflict(self, candidates: list[dict], policy):
+        '''按策略选择冲突文件中要保留的一项'''
+
+        remaining = narrow_candidates(candidates, policy)
+        if len(remaining) == 1 or 'interactive' not in policy:
+            return remaining[0]
+        # 手动解决冲突
+        for idx, c in enumerate(remaining):
+            print(f'[{idx}] {c["filename"]} {c["size"]} {c["filesize"]}')
+        try:
+            select = int(input('请选择要保留的文件，默认为第0项: '))
+            if select < 0 or select >= len(remaining):
+                select = 0
+        except:
+            select = 0
+        return remaining[select]
 
     def __delete_image_preview(self, file: dict):
         '''删除图片预览图'''
@@ -231,6 +524,8 @@ class PixivCollection():
     def __update_data(self, type: str, key: str | int, value: dict):
         '''更新数据'''
         logger.debug(f'更新数据: {type}:{key}')
+        old = getattr(self, DATA_TABLES[type],
+                      {}).get(str(key)) if type in DATA_TABLES else None
         if type == 'author':
             self.authors[str(key)] = {
                 'update': timestamp(),
@@ -253,6 +548,57 @@ class PixivCollection():
             }
         else:
             logger.error(f'未知数据类型: {type}')
+            return
+        self.__dirty[type].add(str(key))
+        self.__index.update(type, str(key), old['data'] if old else None,
+                            value)
+        self.__journal_record(type, str(key))
+
+    def __delete_data(self, type: str, key: str | int):
+        '''删除数据'''
+        logger.debug(f'删除数据: {type}:{key}')
+        old = getattr(self, DATA_TABLES[type]).pop(str(key), None)
+        self.__dirty[type].add(str(key))
+        if old is not None:
+            self.__index.update(type, str(key), old['data'], None)
+        self.__journal_record(type, str(key))
+
+    def __journal_record(self, type: str, key: str):
+        '''记录变动的版本号并将记录的当前状态写入日志, 日志条数达到阈值时保存数据快照'''
+        self.__revision += 1
+        self.__changes[type][key] = self.__revision
+        if self.__journal is None:
+            return
+        table = DATA_TABLES[type]
+        record = getattr(self, table).get(key)
+        if record is None:
+            self.__journal.delete(table, key)
+        else:
+            self.__journal.set(table, key, record)
+        if not self.__journal.in_group:
+            self.__auto_checkpoint()
+
+    def __auto_checkpoint(self):
+        checkpoint_every = self.__journal_options['checkpoint_every']
+        if checkpoint_every and self.__journal.entries >= checkpoint_every:
+            self.checkpoint()
+
+    @contextmanager
+    def __atomic(self):
+        '''其中的变动作为一组写入日志, 崩溃后恢复时全部应用或全部丢弃, 结束后才会自动保存快照'''
+        if self.__journal is None:
+            yield
+            return
+        journal = self.__journal
+        with journal.group():
+            yield
+        if journal is self.__journal and not journal.in_group:
+            self.__auto_checkpoint()
+
+    def __set_watermark(self, key: str, value: list[int]):
+        self.watermarks[key] = value
+        if self.__journal is not None:
+            self.__journal.watermark(key, value)
 
     def __size_match(self, size1: tuple[int, int], size2: tuple[int, int]):
         '''判断尺寸是否匹配'''
@@ -320,77 +666,206 @@ class PixivCollection():
             return None
 
     def read_data(self, file_path: str):
-        '''读取数据'''
-
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-            self.authors = data['authors']
-            self.images = data['images']
-            self.tags = data['tags']
-            self.files = data['files']
-
+        '''读取数据, 扩展名为 .db/.sqlite/.sqlite3 时使用 SQLite 存储, 否则为 JSON
+
+        读取后重放数据文件对应的日志 <file_path>.journal, 恢复上次保存后中断前的变动,
+        之后的变动继续写入该日志
+        '''
+
+        storage = open_storage(file_path)
+        data = storage.load()
+        if self.__journal is not None:
+            self.__journal.close()
+        self.__journal = Journal(journal_path(file_path),
+                                 self.__journal_options['flush_every'])
+        replayed = self.__journal.replay(data)
+        self.authors = data['authors']
+        self.images = data['images']
+        self.tags = data['tags']
+        self.files = data['files']
+        self.watermarks = data['watermarks']
+        self.__storage = storage
+        self.__dirty = {
+            type: replayed[DATA_TABLES[type]]
+            for type in DATA_TABLES
+        }
+        self.__fingerprints = {}
+        for type in DATA_TABLES:
+            for key in self.__dirty[type]:
+                self.__revision += 1
+                self.__changes[type][key] = self.__revision
+        self.__index.build(self.images, self.files, self.authors, self.tags)
+
+        if self.__journal.entries:
+            logger.info(f'从日志恢复{self.__journal.entries}条变动')
         logger.info(
             f'读取数据成功, 文件:{len(self.files)} 图片:{len(self.images)} 作者:{len(self.authors)} 标签:{len(self.tags)}'
         )
 
     def save_data(self, file_path: str):
-        '''保存数据'''
-
-        self.authors = dict(
-            sorted(self.authors.items(), key=lambda x: int(x[0])))
-        self.images = dict(sorted(self.images.items(),
-                                  key=lambda x: int(x[0])))
-        self.files = dict(
-            sorted(self.files.items(),
-                   key=lambda x: x[1]['data']['id'] * 1000 + x[1]['data'][
-                       'part']))
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(
+        '''保存数据
+
+        保存至读取时的 SQLite 文件时只写入变动的记录, 保存至其他文件时全量写入,
+        可用于 JSON 与 SQLite 之间的导入导出; 保存成功后清空日志,
+        保存至其他文件时原文件的日志保留, 之后的变动写入新文件的日志
+        '''
+
+        storage = self.__storage
+        changes = {
+            DATA_TABLES[type]: keys
+            for type, keys in self.__dirty.items()
+        }
+        if storage is None or os.path.abspath(
+                storage.file_path) != os.path.abspath(file_path):
+            storage = open_storage(file_path)
+            changes = None
+        with self.__metrics.timer('save'):
+            written = storage.save(
                 {
                     'authors': self.authors,
                     'images': self.images,
                     'tags': self.tags,
                     'files': self.files,
-                },
-                f,
-                indent=4,
-                ensure_ascii=False)
+                    'watermarks': self.watermarks,
+                }, changes)
+        if written:
+            # JSON 快照内容未变动时保留原文件, SQLite 只写入变动的行, 均不计入
+            self.__metrics.inc('bytes_written',
+                               os.path.getsize(file_path),
+                               kind='data')
+        if self.__journal is None or self.__storage is not storage:
+            if self.__journal is not None:
+                self.__journal.close()
+            self.__journal = Journal(journal_path(file_path),
+                                     self.__journal_options['flush_every'])
+        self.__journal.truncate()
+        self.__storage = storage
+        self.__dirty = {type: set() for type in DATA_TABLES}
         logger.info(
             f'保存数据成功, 文件:{len(self.files)} 图片:{len(self.images)} 作者:{len(self.authors)} 标签:{len(self.tags)}'
         )
 
+    def checkpoint(self):
+        '''将当前数据保存至读取时的文件并清空日志'''
+
+        if self.__storage is None:
+            return
+        self.save_data(self.__storage.file_path)
+
+    def set_journal(self,
+                    flush_every: int = JOURNAL_FLUSH_EVERY,
+                    checkpoint_every: int | None = JOURNAL_CHECKPOINT_EVERY):
+        '''设置日志每 flush_every 条写入一次磁盘, 每 checkpoint_every 条保存一次快照, None 不自动保存'''
+
+        self.__journal_options = {
+            'flush_every': flush_every,
+            'checkpoint_every': checkpoint_every,
+        }
+        if self.__journal is not None:
+            self.__journal.flush_every = flush_every
+
+    def changes(self, since: int = 0):
+        '''返回 (当前版本号, {类型: 版本号大于 since 的变动键集合}), 包括读取时从日志恢复的变动'''
+
+        return self.__revision, {
+            type: {key
+                   for key, revision in changes.items() if revision > since}
+            for type, changes in self.__changes.items()
+        }
+
+    def fingerprint(self, type: str):
+        '''按键与 update 时间戳计算数据表的摘要, 用于跨进程判断数据是否变动'''
+
+        cached = self.__fingerprints.get(type)
+        if cached is not None and cached[0] == self.__revision:
+            return cached[1]
+        table = getattr(self, DATA_TABLES[type])
+        h = hashlib.blake2b(digest_size=16)
+        for key in sorted(table):
+            h.update(f'{key}:{table[key]["update"]}\n'.encode())
+        self.__fingerprints[type] = (self.__revision, h.hexdigest())
+        return self.__fingerprints[type][1]
+
+    def set_cache(self, cache: Cache):
+        '''设置插画与用户信息缓存, 如 SQLiteCache 可跨进程持久化'''
+        self.__cache = cache
+
+    def cache_stats(self):
+        '''缓存命中统计'''
+        return self.__cache.stats()
+
+    def set_metrics(self, metrics: Metrics):
+        '''设置运行指标的记录对象, 多个实例可共用'''
+        self.__metrics = metrics
+
+    def metrics(self):
+        '''运行指标: API 请求与限速等待、下载、重试、解码、编码、写入字节数与缓存命中, 见 metrics.Metrics'''
+        return self.__metrics
+
+    def set_rate_limit(self, rate: float, burst: int = 1):
+        '''设置 API 请求与下载共用的速率限制(每秒请求数)'''
+        self.__limiter.set_rate(rate, burst)
+
+    def set_pixel_budget(self, pixels: int | None):
+        '''设置单次解码的像素预算, 超过预算的 PNG 按条带解码, None 使用默认值
+
+        并行生成预览图时每个进程各自受预算限制
+        '''
+        self.__pixel_budget = pixels
+
     def download_bookmark(self,
                           user_id: int,
                           type='public',
                           max_page=1,
-                          update_image_data=True):
-        '''下载用户收藏'''
+                          update_image_data=True,
+                          workers=1,
+                          incremental=False):
+        '''下载用户收藏, workers 为同时下载的线程数
+
+        incremental 为 True 时记录每个用户公开/非公开收藏最新的若干作品 ID 作为水位线,
+        翻页遇到水位线内的作品即停止, 此时 max_page 为 None 表示不限制页数;
+        水位线之后下载失败的图片需通过一次非增量同步补回
+        '''
 
         download_list = []
         local_files = self.__list_files(self.__path['original'])
-        id_list = [
+        id_set = {
             int(normalize_filename(filename).split('_')[0])
             for filename in local_files
-        ]
+        }
+        watermark_key = f'{user_id}_{type}'
+        known = set(self.watermarks.get(watermark_key,
+                                        [])) if incremental else set()
+        newest = []
+        reached = False
         cur_page = 1
         next_url = None
 
-        while cur_page <= max_page:
+        while not reached and (max_page is None or cur_page <= max_page):
             logger.info(f'获取用户{user_id} {type}收藏第{cur_page}页')
             cur_page += 1
             images = []
             if next_url:
                 qs = self.__api.parse_qs(next_url)
-                res = self.__api.user_bookmarks_illust(**qs)
+                res = self.__call_api('user_bookmarks_illust', self.__limiter,
+                                      self.__api.user_bookmarks_illust, **qs)
             else:
-                res = self.__api.user_bookmarks_illust(user_id, restrict=type)
+                res = self.__call_api('user_bookmarks_illust',
+                                      self.__limiter,
+                                      self.__api.user_bookmarks_illust,
+                                      user_id,
+                                      restrict=type)
             next_url = res['next_url']
             images = res['illusts']
 
             logger.debug(json.dumps(images))
 
             for image in images:
+                if len(newest) < WATERMARK_SIZE:
+                    newest.append(image['id'])
+                # 到达上次同步位置, 处理完本页后停止
+                if image['id'] in known:
+                    reached = True
                 # 只下载插画和漫画
                 if image['type'] not in ['illust', 'manga']:
                     continue
@@ -399,22 +874,12 @@ class PixivCollection():
                     logger.warning(f'图片{image["id"]}已被删除或设置为非公开,跳过下载')
                     continue
                 # 缓存插画信息
-                self.__cache[f'illust_info_{image["id"]}'] = {'illust': image}
-                if image['id'] in id_list:
+                self.__cache.set(f'illust_info_{image["id"]}',
+                                 {'illust': image})
+                if image['id'] in id_set:
                     if update_image_data:
                         # 更新图片数据
-                        self.__update_data('image', image['id'],
-                                           self.convert_image_info(image))
-                        self.__update_data(
-                            'author', image['user']['id'], {
-                                'id': image['user']['id'],
-                                'name': image['user']['name'],
-                                'account': image['user']['account'],
-                            })
-                        for tag in image['tags']:
-                            tag_name = tag['name']
-                            self.__update_data('tag', tag_name, tag)
-                        self.__ensure_ai_tag_defined(image_id=image['id'])
+                        self.__apply_illust(image)
                 else:
                     # 判断是否为多图
                     if image['page_count'] == 1:
@@ -428,73 +893,300 @@ class PixivCollection():
             if next_url is None:
                 break
 
-            time.sleep(WAIT_TIME)
+        if reached:
+            logger.info(f'已到达用户{user_id} {type}收藏上次同步位置')
 
         if len(download_list) == 0:
             logger.info('没有需要下载的图片')
-            return
-        logger.info(f'开始下载{len(download_list)}张图片')
-
-        for image_link in download_list:
-            success = self.__download_image(image_link)
-            if not success:
-                logger.error(f'下载失败: {image_link}, 多次重试失败, 跳过该图片')
+        else:
+            logger.info(f'开始下载{len(download_list)}张图片')
+            self.__download_images(download_list, workers)
+
+        # 下载完成后再更新水位线, 避免中断时跳过未下载的作品
+        if incremental and newest:
+            previous = self.watermarks.get(watermark_key, [])
+            self.__set_watermark(watermark_key,
+                                 (newest + [i for i in previous
+                                            if i not in newest
+                                            ])[:WATERMARK_SIZE])
+
+    def __render_all(self,
+                     kind: str,
+                     overwrite: bool,
+                     size: tuple[int, int],
+                     quality: int,
+                     workers: int = 1,
+                     executor: Executor | None = None,
+                     files: set[str] | None = None):
+        '''批量生成预览图或缩略图
+
+        workers 大于 1 或传入 executor 时在进程池中编码, 同时在途的任务数不超过 2 倍 workers,
+        进度按提交顺序输出, 单个文件失败只记录错误不中断; files 不为 None 时只检查其中的文件;
+        工作进程异常退出(如解码过大的原图时被系统终止)时在途的文件记为失败, 自行创建的进程池重新创建后继续,
+        传入的 executor 无法恢复, 剩余文件均记为失败
+        '''
+
+        label = '大图' if kind == 'preview' else '预览图'
+        jobs = []
+        for filename in (self.files if files is None else
+                         [name for name in files if name in self.files]):
+            file = self.files[filename]['data']
+            dst = f'{self.__path[kind]}{file["id"]}_p{file["part"]}.webp'
+            if not os.path.exists(dst) or overwrite:
+                jobs.append((f'{file["id"]}_{file["part"]}',
+                             self.__path['original'] + filename, dst))
+        failed = []
 
-    def generate_preview(self, overwrite=False, max_size=PREVIEW_SIZE):
-        '''生成预览图'''
+        def collect(name, run):
+            try:
+                stats = run()
+                self.__metrics.observe('decode', stats['decode'], kind=kind)
+                self.__metrics.observe('encode', stats['encode'], kind=kind)
+                self.__metrics.inc('bytes_written', stats['bytes'], kind=kind)
+                logger.info(f'生成{label}: {name} [{done + 1}/{len(jobs)}]')
+            except Exception as e:
+                logger.exception(e)
+                logger.error(f'生成{label}失败: {name}')
+                failed.append(name)
+
+        done = 0
+        if executor is None and workers <= 1:
+            for name, src, dst in jobs:
+                collect(
+                    name, lambda: render_webp(src, dst, size, quality,
+                                              self.__pixel_budget))
+                done += 1
+            return failed
+
+        pool = executor or ProcessPoolExecutor(max_workers=workers)
+        max_inflight = 2 * max(workers, 1)
+        queue = deque(jobs)
+        pending = deque()
+        broken = False
+        try:
+            while queue or pending:
+                if broken and not pending:
+                    if executor is not None:
+                        logger.error(f'进程池已损坏, 剩余{len(queue)}个文件未生成{label}')
+                        failed.extend(name for name, _, _ in queue)
+                        break
+                    logger.warning('工作进程异常退出, 重新创建进程池')
+                    pool.shutdown(cancel_futures=True)
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                    broken = False
+                if queue and not broken and len(pending) < max_inflight:
+                    name, src, dst = queue.popleft()
+                    try:
+                        pending.append(
+                            (name,
+                             pool.submit(render_webp, src, dst, size,
+                                         quality, self.__pixel_budget)))
+                    except BrokenProcessPool:
+                        queue.appendleft((name, src, dst))
+                        broken = True
+                    continue
+                name_, future = pending.popleft()
+                collect(name_, future.result)
+                done += 1
+                if isinstance(future.exception(), BrokenProcessPool):
+                    broken = True
+        finally:
+            if executor is None:
+                pool.shutdown(cancel_futures=True)
+        return failed
+
+    def generate_preview(self,
+                         overwrite=False,
+                         max_size=PREVIEW_SIZE,
+                         workers=1,
+                         executor: Executor | None = None,
+                         files: set[str] | None = None):
+        '''生成预览图, 返回生成失败的文件列表; files 不为 None 时只检查其中的文件'''
+
+        return self.__render_all('preview', overwrite, max_size,
+                                 PREVIEW_QUALITY, workers, executor, files)
+
+    def generate_thumbnail(self,
+                           overwrite=False,
+                           max_size=THUMBNAIL_SIZE,
+                           workers=1,
+                           executor: Executor | None = None,
+                           files: set[str] | None = None):
+        '''生成缩略图, 返回生成失败的文件列表; files 不为 None 时只检查其中的文件'''
+
+        return self.__render_all('thumbnail', overwrite, max_size,
+                                 THUMBNAIL_QUALITY, workers, executor, files)
+
+    def generate_derivatives(self,
+                             overwrite=False,
+                             preview_size=PREVIEW_SIZE,
+                             thumbnail_size=THUMBNAIL_SIZE):
+        '''单次解码同时生成预览图和缩略图, 并刷新文件信息'''
 
         for filename in self.files:
             file = self.files[filename]['data']
-            if not os.path.exists(
-                    f'{self.__path["preview"]}{file["id"]}_p{file["part"]}.webp'
-            ) or overwrite:
-                logger.info(f'生成大图: {file["id"]}_{file["part"]}')
-                self.__generate_image_preview(file, max_size)
+            name = f'{file["id"]}_p{file["part"]}.webp'
+            preview = overwrite or not os.path.exists(self.__path["preview"] +
+                                                      name)
+            thumbnail = overwrite or not os.path.exists(
+                self.__path["thumbnail"] + name)
+            if not preview and not thumbnail:
+                continue
+            logger.info(f'生成大图与预览图: {file["id"]}_{file["part"]}')
+            file_info = self.__process_original(
+                filename, preview_size if preview else None,
+                thumbnail_size if thumbnail else None)
+            self.__update_data('file', filename, file_info)
+
+    def __load_small_images(self, filenames: list[str]):
+        '''读取 80x80 小图用于批量计算颜色信息, 优先从缩略图读取以避免解码原图'''
+        images = []
+        for filename in filenames:
+            file = self.files[filename]['data']
+            thumbnail = (f'{self.__path["thumbnail"]}'
+                         f'{file["id"]}_p{file["part"]}.webp')
+            start = time.perf_counter()
+            if os.path.exists(thumbnail):
+                img = Image.open(thumbnail)
+                kind = 'thumbnail'
+            else:
+                _, img = decode_image(self.__path['original'] + filename,
+                                      PLACEHOLDER_SIZE, self.__pixel_budget)
+                kind = 'original'
+            images.append(img.resize(PLACEHOLDER_SIZE))
+            self.__metrics.observe('decode',
+                                   time.perf_counter() - start,
+                                   kind=kind)
+            img.close()
+        return images
+
+    def __backfill(self, field: str, label: str, encode, overwrite,
+                   batch_size):
+        '''为缺少 field 字段的文件记录批量补充数据, encode 接收小图列表返回对应结果'''
+        pending = [
+            filename for filename in self.files
+            if overwrite or not self.files[filename]['data'].get(field)
+        ]
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            for filename, value in zip(
+                    batch, encode(self.__load_small_images(batch))):
+                if value is None:
+                    continue
+                self.__update_data('file', filename, {
+                    **self.files[filename]['data'], field: value
+                })
+            logger.info(f'生成{label}: {start + len(batch)}/{len(pending)}')
 
-    def generate_thumbnail(self, overwrite=False, max_size=THUMBNAIL_SIZE):
-        '''生成缩略图'''
+    def generate_placeholder(self, overwrite=False, batch_size=256):
+        '''为缺少 BlurHash 的文件记录补充占位图, 每 batch_size 张图片一次完成 DCT'''
 
-        for filename in self.files:
-            file = self.files[filename]['data']
-            if not os.path.exists(
-                    f'{self.__path["thumbnail"]}{file["id"]}_p{file["part"]}.webp'
-            ) or overwrite:
-                logger.info(f'生成预览图: {file["id"]}_{file["part"]}')
-                self.__generate_image_thumbnail(file, max_size)
+        self.__backfill('blurhash', '占位图', blurhash_encode_batch, overwrite,
+                        batch_size)
+
+    def generate_palette(self, overwrite=False, batch_size=256):
+        '''为缺少调色板的文件记录补充调色板, 同一批图片共用直方图缓冲区
+
+        从缩略图计算时结果可能与原图计算的主色调略有差异, 主色调保持不变
+        '''
+
+        def encode(images):
+            return [
+                convert_palette(palette) if palette else None
+                for palette in get_palettes(images, PALETTE_SIZE, 1)
+            ]
+
+        self.__backfill('palette', '调色板', encode, overwrite, batch_size)
 
     def clean(self):
-        '''清理无效数据'''
+        '''清理无效数据
 
-        image_id_list = set(
-            [self.files[file]['data']['id'] for file in self.files])
-        for image_id in self.images.copy():
-            if int(image_id) not in image_id_list:
+        只检查上次清理以来失去文件引用的图片, 以及随之失去引用的作者与标签
+        '''
+
+        for image_id in self.__index.take_orphans('image'):
+            if image_id in self.images:
                 logger.info(f'删除图片数据: {image_id}')
-                del self.images[image_id]
-
-        author_id_list = set([
-            self.images[image_id]['data']['author_id']
-            for image_id in self.images
-        ])
-        for author_id in self.authors.copy():
-            if int(author_id) not in author_id_list:
+                self.__delete_data('image', image_id)
+
+        for author_id in self.__index.take_orphans('author'):
+            if author_id in self.authors:
                 logger.info(f'删除作者数据: {author_id}')
-                del self.authors[author_id]
-
-        tag_name_list = set([
-            tag_name for image_id in self.images
-            for tag_name in self.images[image_id]['data']['tags']
-        ])
-        for tag_name in self.tags.copy():
-            if tag_name not in tag_name_list:
+                self.__delete_data('author', author_id)
+
+        for tag_name in self.__index.take_orphans('tag'):
+            if tag_name in self.tags:
                 logger.info(f'删除标签数据: {tag_name}')
-                del self.tags[tag_name]
+                self.__delete_data('tag', tag_name)
 
-    def diff(self):
-        '''检测文件变动'''
+    def query(self, sort='id', reverse=True, limit=None, **conditions):
+        '''使用倒排索引查询文件, 返回排序后的文件名列表
 
-        local_files = self.__list_files(self.__path['original'])
+        conditions 见 CollectionIndex.match, 如 tags=['原神'], authors=[123], max_sl=2;
+        sort 为 id 时与导出顺序一致, 也可按作品的 bookmark, view, created_at 等字段排序
+        '''
+
+        image_ids = self.__index.match(**conditions)
+        filenames = [
+            filename for image_id in image_ids
+            for filename in self.__index.image_files.get(image_id, ())
+            if filename in self.files
+        ]
+        if sort == 'id':
+            result = export_order({f: self.files[f] for f in filenames})
+            if not reverse:
+                result.reverse()
+        else:
+            result = sorted(
+                filenames,
+                key=lambda f: (self.images[str(self.files[f]['data']['id'])][
+                    'data'][sort], self.files[f]['data']['id'], -self.files[f]
+                               ['data']['part']),
+                reverse=reverse)
+        return result[:limit] if limit is not None else result
+
+    def diff(self,
+             generate_derivatives=False,
+             check_hash=False,
+             conflict_policy=DEFAULT_POLICY,
+             files: set[str] | None = None):
+        '''检测文件变动
+
+        同一 pid_pN 存在多个扩展名时按 conflict_policy 处理, 如 ('duplicate', 'lossless', 'largest')
+        可无人值守运行, 默认 ('interactive',) 由用户选择, 策略说明见 dedup.narrow_candidates;
+
+        单次 scandir 获取每个文件的 (大小, mtime_ns, inode), 仅重新读取与记录不一致的文件;
+        大小不变时默认视为未变动, check_hash 为 True 时比较内容哈希以发现同大小的修改;
+        generate_derivatives 为 True 时, 新增与变动文件在读取信息的同一次解码中生成预览图和缩略图;
+        files 不为 None 时只检查其中的文件(以及与其同一 pid_pN 的已记录文件), 用于监视模式
+        '''
+
+        derivative_size = (PREVIEW_SIZE, THUMBNAIL_SIZE) if generate_derivatives else ()
+
+        scope = None
+
+        def scan():
+            nonlocal scope
+            if files is None:
+                return scan_files(self.__path['original'])
+            scope = set(files)
+            for filename in files:
+                pid = normalize_filename(filename).split('.')[0]
+                scope.update(
+                    name for name in self.__index.image_files.get(
+                        pid.split('_')[0], ()) if name.split('.')[0] == pid)
+            result = {}
+            for filename in scope:
+                try:
+                    result[filename] = file_stat(self.__path['original'] +
+                                                 filename)
+                except FileNotFoundError:
+                    pass
+            return result
+
+        local_files = scan()
 
+        renamed = False
         for filename in local_files:
             if (filename != normalize_filename(filename)):
                 logger.warning(
@@ -503,8 +1195,12 @@ class PixivCollection():
                 os.rename(
                     f'{self.__path["original"]}{filename}',
                     f'{self.__path["original"]}{normalize_filename(filename)}')
+                renamed = True
 
-        local_files = self.__list_files(self.__path['original'])
+        if renamed:
+            if files is not None:
+                files = {normalize_filename(filename) for filename in files}
+            local_files = scan()
 
         # 检测冲突文件
         index = {}
@@ -516,93 +1212,283 @@ class PixivCollection():
 
         for filename in index:
             if len(index[filename]) > 1:
-                # 手动解决冲突
-                logger.warning(f'检测到冲突文件')
-                for idx, ext in enumerate(index[filename]):
-                    file_path = f'{self.__path["original"]}{filename}.{ext}'
-                    im = Image.open(file_path)
-                    print(
-                        f'[{idx}] {filename}.{ext} {im.size} {os.path.getsize(file_path)}'
-                    )
-                    im.close()
-                try:
-                    select = int(input('请选择要保留的文件，默认为第0项: '))
-                    if select < 0 or select >= len(index[filename]):
-                        select = 0
-                except:
-                    select = 0
-                logger.info(
-                    f'保留文件 [{select}]: {filename}.{index[filename][select]}')
-                for idx, ext in enumerate(index[filename]):
-                    if idx != select:
-                        file_path = f'{self.__path["original"]}{filename}.{ext}'
-                        logger.info(f'删除文件 [{idx}]: {filename}.{ext}')
-                        local_files.remove(f'{filename}.{ext}')
-                        os.remove(file_path)
+                logger.warning(f'检测到冲突文件: {filename}')
+                candidates = [
+                    self.__file_hashes(f'{filename}.{ext}')
+                    for ext in index[filename]
+                ]
+                keep = self.__select_conflict(candidates, conflict_policy)
+                logger.info(f'保留文件: {keep["filename"]}')
+                for c in candidates:
+                    if c is not keep:
+                        logger.info(f'删除文件: {c["filename"]}')
+                        del local_files[c['filename']]
+                        os.remove(self.__path['original'] + c['filename'])
 
         # 检测删除文件
-        for filename in self.files.copy():
+        checked = self.files.copy() if scope is None else {
+            filename
+            for filename in scope if filename in self.files
+        }
+        for filename in checked:
             if filename not in local_files:
                 logger.warning(f'检测到删除文件: {filename}')
                 file_info = self.files[filename]['data']
-                del self.files[filename]
+                self.__delete_data('file', filename)
                 self.__delete_image_preview(file_info)
                 self.__delete_image_thumbnail(file_info)
 
         # 检测新增文件
+        added = set()
         for filename in local_files:
             if filename not in self.files:
                 logger.info(f'检测到新增文件: {filename}')
-                file_info = self.__get_file_info(filename)
+                file_info = self.__process_original(filename, *derivative_size)
                 self.__update_data('file', filename, file_info)
+                added.add(filename)
+
+        # 检测与已有文件重复或相似的新增文件
+        for filename in sorted(added):
+            file_data = self.files[filename]['data']
+            same = sorted(self.__index.hash_files.get(file_data['hash'], ()))
+            if len(same) > 1:
+                logger.warning(f'检测到内容相同的文件: {", ".join(same)}')
+            similar = [
+                name for name, _ in self.__index.phashes.search(
+                    file_data['phash'], PHASH_RADIUS) if name not in same
+            ]
+            if similar:
+                logger.warning(
+                    f'检测到内容相似的文件: {filename}, {", ".join(similar)}')
 
         # 检测变动文件
-        for filename in self.files:
+        for filename, stat in local_files.items():
+            if filename in added:
+                continue
             file_data = self.files[filename]['data']
-            filesize = os.path.getsize(self.__path['original'] + filename)
+            if record_stat(file_data) == stat:
+                continue
+            file_path = self.__path['original'] + filename
+            changed = False
             if file_data.get('filesize', None) is None:
-                file_data['filesize'] = filesize
                 file_info = self.__get_file_info(filename)
                 self.__update_data('file', filename, file_info)
-            if file_data['filesize'] != filesize:
+                continue
+            if file_data['filesize'] != stat[0]:
                 logger.info(f'检测到文件大小变动: {filename}')
-                file_info = self.__get_file_info(filename)
+                changed = True
+            elif check_hash and file_data.get('hash', None) is not None:
+                if file_hash(file_path) != file_data['hash']:
+                    logger.info(f'检测到文件内容变动: {filename}')
+                    changed = True
+            if changed:
+                self.__delete_image_preview(file_data)
+                self.__delete_image_thumbnail(file_data)
+                file_info = self.__process_original(filename, *derivative_size)
                 self.__update_data('file', filename, file_info)
-                self.__delete_image_preview(file_info)
-                self.__delete_image_thumbnail(file_info)
+                continue
+            # 内容未变动, 仅更新记录中的 stat
+            old_data = dict(file_data)
+            file_data['mtime_ns'] = stat[1]
+            file_data['inode'] = stat[2]
+            if check_hash and file_data.get('hash', None) is None:
+                file_data['hash'] = file_hash(file_path)
+            self.__dirty['file'].add(filename)
+            self.__index.update('file', filename, old_data, file_data)
+            self.__journal_record('file', filename)
+
+    def find_duplicates(self, compute_missing=True):
+        '''在整个收藏中查找内容哈希或感知哈希相同的文件
+
+        compute_missing 为 True 时为缺少哈希的记录补算并写入记录,
+        返回 {'hash': {哈希: [文件名]}, 'phash': {感知哈希: [文件名]}}
+        '''
+
+        if compute_missing:
+            for filename in self.files:
+                file_data = self.files[filename]['data']
+                if file_data.get('hash') and file_data.get('phash'):
+                    continue
+                info = self.__file_hashes(filename)
+                old_data = dict(file_data)
+                file_data['hash'] = info['hash']
+                file_data['phash'] = info['phash']
+                self.__dirty['file'].add(filename)
+                self.__index.update('file', filename, old_data, file_data)
+                self.__journal_record('file', filename)
+        return {
+            'hash': group_by(self.files, 'hash'),
+            'phash': group_by(self.files, 'phash'),
+        }
 
-    def update(self):
-        '''更新图片数据'''
+    def similar_images(self, filename: str, radius: int = PHASH_RADIUS):
+        '''查询与指定文件感知哈希汉明距离不超过 radius 的其他文件, 返回 [(文件名, 距离)]'''
+        phash = self.files[filename]['data'].get('phash')
+        if phash is None:
+            return []
+        return [(name, d)
+                for name, d in self.__index.phashes.search(phash, radius)
+                if name != filename]
+
+    def duplicate_clusters(self, radius: int = PHASH_RADIUS):
+        '''使用感知哈希 BK 树将相似文件聚为簇, 返回按大小排序的文件名列表的列表'''
+        clusters = self.__index.phashes.clusters(radius)
+        logger.info(f'检测到{len(clusters)}组相似文件')
+        return clusters
+
+    def update(self, workers=1, max_rate=AIMD_MAX_RATE):
+        '''更新图片数据, 获取尚无作品信息, 或引用的作者、标签缺失的作品
+
+        workers 大于 1 时使用线程池并发获取插画信息, 限速器从当前速率开始按 AIMD 自适应调整,
+        响应正常时逐渐提速至不超过 max_rate, 被限流时减半; 结果按文件顺序写入;
+        返回获取失败的作品 ID 列表
+        '''
+
+        missing = []
+        seen = set()
         for filename in self.files:
             image_id = filename.split('_')[0]
-            if image_id in self.images:
-                continue
+            if image_id not in seen and not self.__illust_complete(image_id):
+                seen.add(image_id)
+                missing.append(image_id)
 
-            image_info = self.__get_illust_info(image_id)
+        failed = []
 
+        def apply(image_id, image_info):
             if image_info is None:
                 logger.error(f'获取插画信息失败: {image_id}')
-                continue
-
+                failed.append(image_id)
+                return
             logger.info(f'获取插画信息成功: {image_id}')
+            self.__apply_illust(image_info['illust'])
+
+        if workers <= 1:
+            for image_id in missing:
+                apply(image_id, self.__get_illust_info(image_id))
+            logger.info('图片数据更新完成')
+            return failed
+
+        limiter = AIMDLimiter(self.__limiter.rate, workers, max_rate=max_rate)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for image_id in missing:
+                pending.append((image_id,
+                                pool.submit(self.__get_illust_info, image_id,
+                                            True, limiter)))
+                while len(pending) >= 2 * workers:
+                    image_id_, future = pending.popleft()
+                    apply(image_id_, future.result())
+            while pending:
+                image_id_, future = pending.popleft()
+                apply(image_id_, future.result())
+        logger.info(
+            f'图片数据更新完成, 最终速率:{limiter.rate:.2f}/s 被限流:{limiter.throttles}次')
+        return failed
 
-            author_id = image_info['illust']['user']['id']
-
-            self.__update_data('image', image_id,
-                               self.convert_image_info(image_info['illust']))
-
+    def __illust_complete(self, image_id: str):
+        '''作品信息及其引用的作者与标签均已存在'''
+        image = self.images.get(image_id)
+        if image is None:
+            return False
+        data = image['data']
+        return str(data['author_id']) in self.authors and all(
+            tag in self.tags for tag in data['tags'])
+
+    def __apply_illust(self, illust: dict):
+        '''写入作品、作者与标签信息, 并根据上次获取时的收藏数更新收藏变化率估计'''
+
+        image_id = str(illust['id'])
+        data = self.convert_image_info(illust)
+        rate = estimate_rate(self.images.get(image_id), data, timestamp())
+        if rate is not None:
+            data['bookmark_rate'] = rate
+        # 作品引用的作者与标签必须同时存在, 否则导出时无法连接
+        with self.__atomic():
+            self.__update_data('image', image_id, data)
             self.__update_data(
-                'author', author_id, {
-                    'id': author_id,
-                    'name': image_info['illust']['user']['name'],
-                    'account': image_info['illust']['user']['account'],
+                'author', illust['user']['id'], {
+                    'id': illust['user']['id'],
+                    'name': illust['user']['name'],
+                    'account': illust['user']['account'],
                 })
-
-            for tag in image_info['illust']['tags']:
-                tag_name = tag['name']
-                self.__update_data('tag', tag_name, tag)
+            for tag in illust['tags']:
+                self.__update_data('tag', tag['name'], tag)
             self._ensure_ai_illust_tag(image_id)
-        logger.info('图片数据更新完成')
+
+    def refresh(self,
+                budget: int = 100,
+                user_id: int | None = None,
+                types=('public', 'private'),
+                min_interval: float = REFRESH_MIN_INTERVAL):
+        '''刷新已过时的作品信息(收藏数、浏览数等), 最多调用 budget 次 API, 重试也计入次数
+
+        距上次获取超过 min_interval 秒的作品按 估计每天收藏变化量 × 过时天数 排序;
+        指定 user_id 时先翻页获取该用户收藏, 每页可刷新一批作品,
+        某一页中待刷新的作品少于 BOOKMARK_PAGE_MIN_HITS 个时停止翻页,
+        剩余次数按优先级逐个获取作品详情; 返回 {'calls', 'refreshed', 'remaining'}
+        '''
+
+        scheduler = RefreshScheduler(self.images, timestamp(), min_interval)
+        logger.info(f'待刷新作品: {len(scheduler)}')
+        start = self.__api_calls
+
+        def calls():
+            # 实际发出的请求数, 包括 __get_illust_info 中的重试
+            return self.__api_calls - start
+
+        refreshed = set()
+        for type in (types if user_id is not None else ()):
+            next_url = None
+            while calls() < budget and len(scheduler):
+                if next_url:
+                    res = self.__call_api('user_bookmarks_illust',
+                                          self.__limiter,
+                                          self.__api.user_bookmarks_illust,
+                                          **self.__api.parse_qs(next_url))
+                else:
+                    res = self.__call_api('user_bookmarks_illust',
+                                          self.__limiter,
+                                          self.__api.user_bookmarks_illust,
+                                          user_id,
+                                          restrict=type)
+                hits = 0
+                for illust in res['illusts']:
+                    image_id = str(illust['id'])
+                    if image_id not in self.images or not illust[
+                            'visible'] or image_id in refreshed:
+                        continue
+                    if image_id in scheduler.due:
+                        hits += 1
+                    scheduler.discard(image_id)
+                    self.__cache.set(f'illust_info_{image_id}',
+                                     {'illust': illust})
+                    self.__apply_illust(illust)
+                    refreshed.add(image_id)
+                logger.info(f'通过用户{user_id} {type}收藏刷新{hits}个作品')
+                next_url = res['next_url']
+                if next_url is None or hits < BOOKMARK_PAGE_MIN_HITS:
+                    break
+        while calls() < budget:
+            image_id = scheduler.pop()
+            if image_id is None:
+                break
+            image_info = self.__get_illust_info(
+                image_id,
+                use_cache=False,
+                max_retry=min(MAX_RETRY, budget - calls() - 1))
+            if image_info is None:
+                logger.error(f'刷新插画信息失败: {image_id}')
+                continue
+            self.__apply_illust(image_info['illust'])
+            refreshed.add(image_id)
+        logger.info(
+            f'作品信息刷新完成, API 调用:{calls()} 刷新:{len(refreshed)} 剩余:{len(scheduler)}'
+        )
+        return {
+            'calls': calls(),
+            'refreshed': len(refreshed),
+            'remaining': len(scheduler),
+        }
 
     def _ensure_ai_illust_tag(self, image_id):
         """Ensure the AI illustration tag is registered when present on an image."""
@@ -643,60 +1529,111 @@ class PixivCollection():
                 if self.images[image_id]['data']['view'] <= 0:
                     logger.warning(f'检测到无浏览数图片: {file["id"]}_{file["part"]}')
 
+    def nearest_color(self, color: str, k: int = 10):
+        '''查询主色调最接近 #rrggbb 的 k 个文件, 返回 [(文件名, ΔE)]'''
+        return self.__index.colors.nearest(color, k)
+
+    def similar_color(self, color: str, delta_e: float = 10):
+        '''查询主色调与 #rrggbb 的 ΔE 不超过 delta_e 的文件, 返回 [(文件名, ΔE)]'''
+        return self.__index.colors.within(color, delta_e)
+
     def export(self,
                file_path: str,
                filter_max_sl: int = -1,
-               exclude_items: dict = {}):
-        '''导出数据'''
-        exclude_author = exclude_items.get('author', [])
-        exclude_illust = exclude_items.get('illust', [])
-        result = []
-        for file in self.files:
-            image_id = str(self.files[file]['data']['id'])
-            if filter_max_sl != -1:
-                if self.images[image_id]['data'][
-                        'sanity_level'] > filter_max_sl:
-                    continue
-            if self.images[image_id]['data']['author_id'] in exclude_author:
-                continue
-            if self.images[image_id]['data']['id'] in exclude_illust:
-                continue
-            author_id = str(self.images[image_id]['data']['author_id'])
-            image = {
-                'id':
-                self.files[file]['data']['id'],
-                'part':
-                self.files[file]['data']['part'],
-                'title':
-                self.images[image_id]['data']['title'],
-                'size':
-                self.files[file]['data']['size'],
-                'ext':
-                self.files[file]['data']['ext'],
-                'author':
-                self.authors[author_id]['data'],
-                'tags': [
-                    self.tags[tag]['data']
-                    for tag in self.images[image_id]['data']['tags']
-                ],
-                'created_at':
-                self.images[image_id]['data']['created_at'],
-                'sanity_level':
-                self.images[image_id]['data']['sanity_level'],
-                'x_restrict':
-                self.images[image_id]['data']['x_restrict'],
-                'bookmark':
-                self.images[image_id]['data']['bookmark'],
-                'view':
-                self.images[image_id]['data']['view'],
-                'dominant_color':
-                self.files[file]['data']['dominant_color'],
-            }
-            result.append(image)
-
-        result.sort(key=lambda x: x['id'] * 1000 + 999 - x['part'],
-                    reverse=True)
-        logger.info(f'导出{len(result)}条数据至 {file_path}')
+               exclude_items: dict = {},
+               shard_size: int | None = None,
+               query: dict | None = None):
+        '''导出数据
+
+        按导出顺序逐条写入文件, shard_size 不为 None 时额外输出分片文件与清单, 见 exporter.write_export;
+        query 不为 None 时只导出 self.query(**query) 的结果并按其顺序排列
+        '''
+        records = iter_records(self.authors,
+                               self.images,
+                               self.tags,
+                               self.files,
+                               filter_max_sl=filter_max_sl,
+                               exclude_author=set(
+                                   exclude_items.get('author', [])),
+                               exclude_illust=set(
+                                   exclude_items.get('illust', [])),
+                               order=self.query(
+                                   **query) if query is not None else None)
+        with self.__metrics.timer('export'):
+            count, changed = write_export(file_path, records, shard_size)
+        if changed:
+            self.__metrics.inc('bytes_written',
+                               os.path.getsize(file_path),
+                               kind='export')
+        logger.info(f'导出{count}条数据至 {file_path}')
+
+    def export_delta(self,
+                     file_path: str,
+                     filter_max_sl: int = -1,
+                     exclude_items: dict = {},
+                     compact_every: int = DELTA_COMPACT_EVERY,
+                     shard_size: int | None = None):
+        '''增量导出, 只输出相比上次导出新增、变动与删除的记录, 见 exporter.write_delta_export'''
+        records = iter_records(self.authors,
+                               self.images,
+                               self.tags,
+                               self.files,
+                               filter_max_sl=filter_max_sl,
+                               exclude_author=set(
+                                   exclude_items.get('author', [])),
+                               exclude_illust=set(
+                                   exclude_items.get('illust', [])),
+                               with_version=True)
+        with self.__metrics.timer('export', mode='delta'):
+            result = write_delta_export(file_path, records, compact_every,
+                                        shard_size)
+        if not (result['snapshot'] or result['added'] or result['updated']
+                or result['removed']):
+            logger.info(f'增量导出至 {file_path}: 没有变动')
+            return result
+        logger.info(
+            f'增量导出第{result["generation"]}代至 {file_path}, 新增:{result["added"]} 更新:{result["updated"]} 删除:{result["removed"]}'
+            + (', 已生成全量快照' if result['snapshot'] else ''))
+        return result
 
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False)
+    def watch(self,
+              export_path: str | None = None,
+              workers=1,
+              conflict_policy=WATCH_CONFLICT_POLICY,
+              debounce: float = WATCH_DEBOUNCE,
+              poll_interval: float = WATCH_POLL_INTERVAL,
+              timeout: float | None = None):
+        '''监视原图目录, 持续处理新增、修改与删除的文件, Ctrl-C 停止
+
+        每批写入完成的文件依次经过 diff(只检查变动的文件, 同时生成预览图与缩略图)、
+        update 获取新作品信息, 指定 export_path 时再增量导出; 冲突文件按 conflict_policy 自动处理;
+        timeout 秒内没有文件变动时返回
+        '''
+
+        watcher = DirectoryWatcher(self.__path['original'], debounce,
+                                   poll_interval)
+        watcher.start()
+        if watcher.polling:
+            logger.warning(
+                f'未安装 watchdog, 每{poll_interval}秒轮询一次目录, 运行 pip install watchdog 以使用文件系统事件'
+            )
+        logger.info(f'开始监视目录: {self.__path["original"]}')
+        try:
+            while True:
+                batch = watcher.next_batch(timeout)
+                if not batch:
+                    break
+                logger.info(f'检测到{len(batch)}个文件变动')
+                self.diff(generate_derivatives=True,
+                          conflict_policy=conflict_policy,
+                          files=batch)
+                self.update(workers)
+                if export_path is not None:
+                    self.export_delta(export_path)
+                if self.__journal is not None:
+                    self.__journal.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.stop()
+            logger.info('停止监视')
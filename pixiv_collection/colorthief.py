@@ -14,6 +14,11 @@ import math
 
 from PIL import Image
 
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
 
 class cached_property(object):
     """Decorator that creates converts a method with a single
@@ -28,17 +33,26 @@ class cached_property(object):
         return res
 
 
+class EmptyPixels(Exception):
+    """No opaque, non-white pixel left to quantize."""
+
+
 class ColorThief(object):
     """Color thief main class."""
 
-    def __init__(self, image):
+    def __init__(self, image, engine=None):
         """Create one color thief for one image.
 
         :param file: A filename (string) or a file object. The file object
                      must implement `read()`, `seek()`, and `tell()` methods,
                      and be opened in binary mode.
+        :param engine: the quantizer class, `NumpyMMCQ` when numpy is
+                       available, otherwise the pure Python `MMCQ`
         """
         self.image = image.resize((80, 80))
+        if engine is None:
+            engine = NumpyMMCQ if np is not None else MMCQ
+        self.engine = engine
 
     def get_color(self, quality=10):
         """Get the dominant color.
@@ -62,22 +76,75 @@ class ColorThief(object):
                         greater the likelihood that colors will be missed.
         :return list: a list of tuple in the form (r, g, b)
         """
+        return self.quantize(color_count, quality).palette
+
+    def get_weighted_palette(self, color_count=10, quality=10):
+        """Build a color palette together with the share of sampled pixels
+        each color stands for.  Colors are in the same order as
+        `get_palette`.
+
+        :return list: a list of tuple in the form ((r, g, b), weight)
+        """
+        return self.quantize(color_count, quality).weighted_palette
+
+    def quantize(self, color_count=10, quality=10, histo=None):
+        """Run the quantizer and return the `CMap`.
+
+        :param histo: a histogram buffer from a previous call with the same
+                      engine, reused instead of allocating a new one
+        """
         image = self.image.convert('RGBA')
-        width, height = image.size
-        pixels = image.getdata()
-        pixel_count = width * height
-        valid_pixels = []
-        for i in range(0, pixel_count, quality):
-            r, g, b, a = pixels[i]
-            # If pixel is mostly opaque and not white
-            if a >= 125:
-                if not (r > 250 and g > 250 and b > 250):
-                    valid_pixels.append((r, g, b))
+        if issubclass(self.engine, NumpyMMCQ):
+            valid_pixels = self.engine.valid_pixels(image, quality)
+        else:
+            width, height = image.size
+            pixels = image.getdata()
+            pixel_count = width * height
+            valid_pixels = []
+            for i in range(0, pixel_count, quality):
+                r, g, b, a = pixels[i]
+                # If pixel is mostly opaque and not white
+                if a >= 125:
+                    if not (r > 250 and g > 250 and b > 250):
+                        valid_pixels.append((r, g, b))
 
         # Send array to quantize function which clusters values
         # using median cut algorithm
-        cmap = MMCQ.quantize(valid_pixels, color_count)
-        return cmap.palette
+        return self.engine.quantize(valid_pixels, color_count, histo)
+
+
+def get_palettes(images, color_count=10, quality=10, engine=None):
+    """Build weighted palettes for many images, reusing one histogram
+    buffer for the whole batch.
+
+    :param images: PIL images, or uint8 pixel arrays of shape (..., 3) or
+                   (..., 4) that are already reduced and are used as is
+                   (numpy engine only)
+    :return list: one `get_weighted_palette` result per image, None for
+                  images without any usable pixel
+    """
+    if engine is None:
+        engine = NumpyMMCQ if np is not None else MMCQ
+    histo = None
+    palettes = []
+    for image in images:
+        if isinstance(image, Image.Image):
+            thief = ColorThief(image, engine)
+            try:
+                cmap = thief.quantize(color_count, quality, histo)
+            except EmptyPixels:
+                palettes.append(None)
+                continue
+        else:
+            pixels = engine.valid_pixels(image, quality)
+            if not len(pixels):
+                palettes.append(None)
+                continue
+            cmap = engine.quantize(pixels, color_count, histo)
+        histo = cmap.histo
+        # read everything out before the buffer is refilled
+        palettes.append(cmap.weighted_palette)
+    return palettes
 
 
 class MMCQ(object):
@@ -94,22 +161,25 @@ class MMCQ(object):
     def get_color_index(r, g, b):
         return (r << (2 * MMCQ.SIGBITS)) + (g << MMCQ.SIGBITS) + b
 
-    @staticmethod
-    def get_histo(pixels):
+    @classmethod
+    def get_histo(cls, pixels, out=None):
         """histo (1-d array, giving the number of pixels in each quantized
         region of color space)
+
+        :param out: a histogram from a previous call, cleared and refilled
         """
-        histo = dict()
+        histo = dict() if out is None else out
+        histo.clear()
         for pixel in pixels:
             rval = pixel[0] >> MMCQ.RSHIFT
             gval = pixel[1] >> MMCQ.RSHIFT
             bval = pixel[2] >> MMCQ.RSHIFT
-            index = MMCQ.get_color_index(rval, gval, bval)
+            index = cls.get_color_index(rval, gval, bval)
             histo[index] = histo.setdefault(index, 0) + 1
         return histo
 
-    @staticmethod
-    def vbox_from_pixels(pixels, histo):
+    @classmethod
+    def vbox_from_pixels(cls, pixels, histo):
         rmin = 1000000
         rmax = 0
         gmin = 1000000
@@ -128,54 +198,63 @@ class MMCQ(object):
             bmax = max(bval, bmax)
         return VBox(rmin, rmax, gmin, gmax, bmin, bmax, histo)
 
-    @staticmethod
-    def median_cut_apply(histo, vbox):
-        if not vbox.count:
-            return (None, None)
+    @classmethod
+    def partial_sums(cls, histo, vbox, color):
+        """Find the partial sum arrays along the selected axis.
 
-        rw = vbox.r2 - vbox.r1 + 1
-        gw = vbox.g2 - vbox.g1 + 1
-        bw = vbox.b2 - vbox.b1 + 1
-        maxw = max([rw, gw, bw])
-        # only one pixel, no split
-        if vbox.count == 1:
-            return (vbox.copy, None)
-        # Find the partial sum arrays along the selected axis.
+        :return tuple: (partialsum, total)
+        """
         total = 0
-        sum_ = 0
         partialsum = {}
-        lookaheadsum = {}
-        do_cut_color = None
-        if maxw == rw:
-            do_cut_color = 'r'
+        if color == 'r':
             for i in range(vbox.r1, vbox.r2 + 1):
                 sum_ = 0
                 for j in range(vbox.g1, vbox.g2 + 1):
                     for k in range(vbox.b1, vbox.b2 + 1):
-                        index = MMCQ.get_color_index(i, j, k)
+                        index = cls.get_color_index(i, j, k)
                         sum_ += histo.get(index, 0)
                 total += sum_
                 partialsum[i] = total
-        elif maxw == gw:
-            do_cut_color = 'g'
+        elif color == 'g':
             for i in range(vbox.g1, vbox.g2 + 1):
                 sum_ = 0
                 for j in range(vbox.r1, vbox.r2 + 1):
                     for k in range(vbox.b1, vbox.b2 + 1):
-                        index = MMCQ.get_color_index(j, i, k)
+                        index = cls.get_color_index(j, i, k)
                         sum_ += histo.get(index, 0)
                 total += sum_
                 partialsum[i] = total
-        else:  # maxw == bw
-            do_cut_color = 'b'
+        else:  # color == 'b'
             for i in range(vbox.b1, vbox.b2 + 1):
                 sum_ = 0
                 for j in range(vbox.r1, vbox.r2 + 1):
                     for k in range(vbox.g1, vbox.g2 + 1):
-                        index = MMCQ.get_color_index(j, k, i)
+                        index = cls.get_color_index(j, k, i)
                         sum_ += histo.get(index, 0)
                 total += sum_
                 partialsum[i] = total
+        return partialsum, total
+
+    @classmethod
+    def median_cut_apply(cls, histo, vbox):
+        if not vbox.count:
+            return (None, None)
+
+        rw = vbox.r2 - vbox.r1 + 1
+        gw = vbox.g2 - vbox.g1 + 1
+        bw = vbox.b2 - vbox.b1 + 1
+        maxw = max([rw, gw, bw])
+        # only one pixel, no split
+        if vbox.count == 1:
+            return (vbox.copy, None)
+        if maxw == rw:
+            do_cut_color = 'r'
+        elif maxw == gw:
+            do_cut_color = 'g'
+        else:  # maxw == bw
+            do_cut_color = 'b'
+        partialsum, total = cls.partial_sums(histo, vbox, do_cut_color)
+        lookaheadsum = {}
         for i, d in partialsum.items():
             lookaheadsum[i] = total - d
 
@@ -207,19 +286,20 @@ class MMCQ(object):
                 return (vbox1, vbox2)
         return (None, None)
 
-    @staticmethod
-    def quantize(pixels, max_color):
+    @classmethod
+    def quantize(cls, pixels, max_color, histo=None):
         """Quantize.
 
         :param pixels: a list of pixel in the form (r, g, b)
         :param max_color: max number of colors
+        :param histo: histogram buffer to reuse, see `get_histo`
         """
-        if not pixels:
-            raise Exception('Empty pixels when quantize.')
+        if len(pixels) == 0:
+            raise EmptyPixels('Empty pixels when quantize.')
         if max_color < 2 or max_color > 256:
             raise Exception('Wrong number of max colors when quantize.')
 
-        histo = MMCQ.get_histo(pixels)
+        histo = cls.get_histo(pixels, histo)
 
         # check that we aren't below maxcolors already
         if len(histo) <= max_color:
@@ -227,7 +307,7 @@ class MMCQ(object):
             pass
 
         # get the beginning vbox from the colors
-        vbox = MMCQ.vbox_from_pixels(pixels, histo)
+        vbox = cls.vbox_from_pixels(pixels, histo)
         pq = PQueue(lambda x: x.count)
         pq.push(vbox)
 
@@ -242,7 +322,7 @@ class MMCQ(object):
                     n_iter += 1
                     continue
                 # do the cut
-                vbox1, vbox2 = MMCQ.median_cut_apply(histo, vbox)
+                vbox1, vbox2 = cls.median_cut_apply(histo, vbox)
                 if not vbox1:
                     raise Exception("vbox1 not defined; shouldn't happen!")
                 lh.push(vbox1)
@@ -268,12 +348,104 @@ class MMCQ(object):
         iter_(pq2, max_color - pq2.size())
 
         # calculate the actual colors
-        cmap = CMap()
+        cmap = CMap(histo)
         while pq2.size():
             cmap.push(pq2.pop())
         return cmap
 
 
+class NumpyMMCQ(MMCQ):
+    """Vectorized MMCQ.  The histogram is a dense 32x32x32 array built with
+    `np.bincount`, and vbox counts and averages are answered in O(1) from
+    cumulative-sum tables.  Produces the same palette as `MMCQ`.
+    """
+
+    @staticmethod
+    def valid_pixels(image, quality=1):
+        """Sample an RGBA image (or an RGB / RGBA pixel array) and drop
+        transparent and white pixels.
+
+        :return: uint8 array of shape (n, 3)
+        """
+        pixels = np.asarray(image, dtype=np.uint8)
+        pixels = pixels.reshape(-1, pixels.shape[-1])[::quality]
+        keep = ~(pixels[:, :3] > 250).all(axis=1)
+        if pixels.shape[1] == 4:
+            keep &= pixels[:, 3] >= 125
+        return pixels[keep, :3]
+
+    @classmethod
+    def quantized(cls, pixels):
+        pixels = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+        return pixels >> cls.RSHIFT
+
+    @classmethod
+    def get_histo(cls, pixels, out=None):
+        q = cls.quantized(pixels).astype(np.intp)
+        index = cls.get_color_index(q[:, 0], q[:, 1], q[:, 2])
+        side = 1 << cls.SIGBITS
+        counts = np.bincount(index, minlength=side ** 3)
+        if out is None:
+            out = HistoTable(side)
+        out.fill(counts.reshape(side, side, side))
+        return out
+
+    @classmethod
+    def vbox_from_pixels(cls, pixels, histo):
+        q = cls.quantized(pixels)
+        lo = q.min(axis=0).tolist()
+        hi = q.max(axis=0).tolist()
+        return NumpyVBox(lo[0], hi[0], lo[1], hi[1], lo[2], hi[2], histo)
+
+    @classmethod
+    def partial_sums(cls, histo, vbox, color):
+        box = histo.counts[vbox.r1:vbox.r2 + 1, vbox.g1:vbox.g2 + 1,
+                           vbox.b1:vbox.b2 + 1]
+        axis = 'rgb'.index(color)
+        others = tuple(i for i in range(3) if i != axis)
+        sums = np.cumsum(box.sum(axis=others)).tolist()
+        start = getattr(vbox, color + '1')
+        partialsum = {start + i: s for i, s in enumerate(sums)}
+        return partialsum, sums[-1]
+
+
+class HistoTable(object):
+    """Dense histogram plus 3d summed-area tables of the pixel count and of
+    the count weighted by each channel index.  The tables are allocated
+    once and refilled in place by `fill`, so one instance can serve a
+    whole batch of images.
+    """
+
+    def __init__(self, side):
+        self.counts = None
+        self.index = np.arange(side, dtype=np.int64)
+        self.table = np.zeros((4, side + 1, side + 1, side + 1),
+                              dtype=np.int64)
+
+    def fill(self, counts):
+        self.counts = counts
+        idx = self.index
+        inner = self.table[:, 1:, 1:, 1:]
+        inner[0] = counts
+        np.multiply(counts, idx[:, None, None], out=inner[1])
+        np.multiply(counts, idx[None, :, None], out=inner[2])
+        np.multiply(counts, idx[None, None, :], out=inner[3])
+        for axis in (1, 2, 3):
+            np.cumsum(inner, axis=axis, out=inner)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts))
+
+    def box_sum(self, r1, r2, g1, g2, b1, b2):
+        """Sums over the inclusive box, as (count, r_sum, g_sum, b_sum)."""
+        t = self.table
+        r2, g2, b2 = r2 + 1, g2 + 1, b2 + 1
+        s = (t[:, r2, g2, b2] - t[:, r1, g2, b2] - t[:, r2, g1, b2] -
+             t[:, r2, g2, b1] + t[:, r1, g1, b2] + t[:, r1, g2, b1] +
+             t[:, r2, g1, b1] - t[:, r1, g1, b1])
+        return s.tolist()
+
+
 class VBox(object):
     """3d color space box"""
 
@@ -349,16 +521,59 @@ class VBox(object):
         return npix
 
 
+class NumpyVBox(VBox):
+    """VBox backed by a `HistoTable`"""
+
+    @property
+    def copy(self):
+        return NumpyVBox(self.r1, self.r2, self.g1, self.g2, self.b1, self.b2,
+                         self.histo)
+
+    @cached_property
+    def sums(self):
+        return self.histo.box_sum(self.r1, self.r2, self.g1, self.g2, self.b1,
+                                  self.b2)
+
+    @cached_property
+    def avg(self):
+        ntot, r_idx, g_idx, b_idx = self.sums
+        mult = 1 << (8 - MMCQ.SIGBITS)
+        if ntot:
+            # sum(hval * (i + 0.5) * mult), kept in integers
+            r_avg = int((r_idx * mult + ntot * mult // 2) / ntot)
+            g_avg = int((g_idx * mult + ntot * mult // 2) / ntot)
+            b_avg = int((b_idx * mult + ntot * mult // 2) / ntot)
+        else:
+            r_avg = int(mult * (self.r1 + self.r2 + 1) / 2)
+            g_avg = int(mult * (self.g1 + self.g2 + 1) / 2)
+            b_avg = int(mult * (self.b1 + self.b2 + 1) / 2)
+
+        return r_avg, g_avg, b_avg
+
+    @cached_property
+    def count(self):
+        return self.sums[0]
+
+
 class CMap(object):
     """Color map"""
 
-    def __init__(self):
+    def __init__(self, histo=None):
+        self.histo = histo
         self.vboxes = PQueue(lambda x: x['vbox'].count * x['vbox'].volume)
 
     @property
     def palette(self):
         return self.vboxes.map(lambda x: x['color'])
 
+    @property
+    def weighted_palette(self):
+        """Palette colors with the fraction of pixels in each vbox."""
+        counts = self.vboxes.map(lambda x: x['vbox'].count)
+        total = sum(counts) or 1
+        return [(color, count / total)
+                for color, count in zip(self.palette, counts)]
+
     def push(self, vbox):
         self.vboxes.push({
             'vbox': vbox,
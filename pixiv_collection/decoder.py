@@ -0,0 +1,374 @@
+import math
+import os
+import struct
+import zlib
+
+from PIL import Image
+
+PIXEL_BUDGET = 16 * 1024 * 1024
+READ_SIZE = 64 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# 条带解码支持的格式, 原始行数据与 Pillow 图像数据可互相转换: (颜色类型, 位深) -> (mode, rawmode)
+PNG_MODES = {
+    (0, 1): ('1', '1'),
+    (0, 8): ('L', 'L'),
+    (2, 8): ('RGB', 'RGB'),
+    (3, 1): ('P', 'P;1'),
+    (3, 2): ('P', 'P;2'),
+    (3, 4): ('P', 'P;4'),
+    (3, 8): ('P', 'P'),
+    (4, 8): ('LA', 'LA'),
+    (6, 8): ('RGBA', 'RGBA'),
+}
+ADAM7_PASSES = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+                (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+
+
+class ImageIntegrityError(Exception):
+    '''图片数据损坏或不完整'''
+
+
+def fit_size(size: tuple[int, int], max_size: tuple[int, int]):
+    '''计算等比缩放至 max_size 以内的尺寸'''
+    scale = min(max_size[0] / size[0], max_size[1] / size[1], 1)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+class PngStream():
+    '''流式读取 PNG, 校验每个块的 CRC, 按需解压 IDAT, 内存占用与图片尺寸无关
+
+    打开时读取至第一个 IDAT 块之前, 之后由 iter_raw 逐段生成解压后的行数据
+    '''
+
+    def __init__(self, file_path: str):
+        self.__file = open(file_path, 'rb')
+        self.__chunks = self.__iter_chunks()
+        self.ancillary = {}
+        self.__first = None
+        try:
+            if self.__file.read(8) != PNG_SIGNATURE:
+                raise ImageIntegrityError('不是 PNG 文件')
+            for chunk_type, data in self.__chunks:
+                if chunk_type == b'IHDR':
+                    (self.width, self.height, self.bit_depth, self.color_type,
+                     _, _, self.interlace) = struct.unpack('>IIBBBBB', data)
+                elif chunk_type == b'IDAT':
+                    self.__first = data
+                    break
+                elif chunk_type in (b'PLTE', b'tRNS'):
+                    self.ancillary[chunk_type] = data
+                elif chunk_type == b'IEND':
+                    break
+            if self.__first is None or not hasattr(self, 'width'):
+                raise ImageIntegrityError('PNG 缺少图像数据')
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def row_bytes(self, width: int | None = None):
+        '''单行数据的字节数, 不含过滤类型字节'''
+        bits = PNG_CHANNELS[self.color_type] * self.bit_depth
+        return math.ceil((self.width if width is None else width) * bits / 8)
+
+    def raw_size(self):
+        '''解压后数据的总字节数'''
+        if not self.interlace:
+            return self.height * (1 + self.row_bytes())
+        total = 0
+        for x0, y0, dx, dy in ADAM7_PASSES:
+            w = max(0, math.ceil((self.width - x0) / dx))
+            h = max(0, math.ceil((self.height - y0) / dy))
+            if w and h:
+                total += h * (1 + self.row_bytes(w))
+        return total
+
+    def __iter_chunks(self):
+        '''生成 (块类型, 数据), IDAT 按 READ_SIZE 分段生成, 每个块读取完毕后校验 CRC'''
+        while True:
+            header = self.__file.read(8)
+            if len(header) < 8:
+                raise ImageIntegrityError('PNG 文件不完整')
+            length, chunk_type = struct.unpack('>I4s', header)
+            crc = zlib.crc32(chunk_type)
+            pieces = []
+            remaining = length
+            while remaining:
+                piece = self.__file.read(min(remaining, READ_SIZE))
+                if not piece:
+                    raise ImageIntegrityError('PNG 文件不完整')
+                crc = zlib.crc32(piece, crc)
+                remaining -= len(piece)
+                if chunk_type == b'IDAT':
+                    yield chunk_type, piece
+                else:
+                    pieces.append(piece)
+            trailer = self.__file.read(4)
+            if len(trailer) < 4:
+                raise ImageIntegrityError('PNG 文件不完整')
+            if struct.unpack('>I', trailer)[0] != crc:
+                raise ImageIntegrityError(
+                    f'PNG 块校验失败: {chunk_type.decode("latin-1")}')
+            if chunk_type != b'IDAT':
+                yield chunk_type, b''.join(pieces)
+
+    def iter_raw(self):
+        '''逐段生成解压后的数据, 结束时检查数据长度、过滤类型与 IEND'''
+        expected = self.raw_size()
+        row_size = 1 + self.row_bytes()
+        decompressor = zlib.decompressobj()
+        total = 0
+        ended = False
+
+        def check(data):
+            nonlocal total
+            if total + len(data) > expected:
+                raise ImageIntegrityError('PNG 图像数据过长')
+            if not self.interlace:
+                # 每行首字节为过滤类型, 取值 0-4
+                first = -total % row_size
+                if any(b > 4 for b in data[first::row_size]):
+                    raise ImageIntegrityError('PNG 过滤类型错误')
+            total += len(data)
+            return data
+
+        try:
+            piece = self.__first
+            chunks = self.__chunks
+            while True:
+                data = piece
+                while data:
+                    out = decompressor.decompress(data, READ_SIZE * 16)
+                    data = decompressor.unconsumed_tail
+                    if out:
+                        yield check(out)
+                chunk_type, piece = next(chunks)
+                if chunk_type == b'IEND':
+                    ended = True
+                    break
+                if chunk_type != b'IDAT':
+                    # IDAT 之后只允许出现辅助块
+                    for chunk_type, piece in chunks:
+                        if chunk_type == b'IDAT':
+                            raise ImageIntegrityError('PNG IDAT 块不连续')
+                        if chunk_type == b'IEND':
+                            ended = True
+                            break
+                    break
+            out = decompressor.flush()
+            if out:
+                yield check(out)
+        except zlib.error as e:
+            raise ImageIntegrityError(f'PNG 图像数据损坏: {e}') from e
+        if not decompressor.eof or total != expected:
+            raise ImageIntegrityError('PNG 图像数据不完整')
+        if not ended:
+            raise ImageIntegrityError('PNG 缺少 IEND')
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def verify_png(file_path: str):
+    '''流式校验 PNG 完整性, 不生成位图, 返回尺寸'''
+    with PngStream(file_path) as png:
+        for _ in png.iter_raw():
+            pass
+        return png.size
+
+
+def read_exact(f, size: int):
+    data = f.read(size)
+    if len(data) != size:
+        raise ImageIntegrityError('文件不完整')
+    return data
+
+
+def verify_gif(file_path: str):
+    '''逐块读取 GIF, 检查各帧的数据子块完整且以结束符结尾, 不解码 LZW 像素数据'''
+    with open(file_path, 'rb') as f:
+        header = read_exact(f, 13)
+        if header[:6] not in (b'GIF87a', b'GIF89a'):
+            raise ImageIntegrityError('不是 GIF 文件')
+        if header[10] & 0x80:
+            # 全局调色板
+            read_exact(f, 3 << ((header[10] & 7) + 1))
+        frames = 0
+        while True:
+            block = read_exact(f, 1)
+            if block == b';':
+                break
+            if block == b'!':
+                read_exact(f, 1)
+            elif block == b',':
+                descriptor = read_exact(f, 9)
+                if descriptor[8] & 0x80:
+                    read_exact(f, 3 << ((descriptor[8] & 7) + 1))
+                # LZW 最小码长
+                read_exact(f, 1)
+                frames += 1
+            else:
+                raise ImageIntegrityError(f'GIF 块类型无效: {block.hex()}')
+            while True:
+                length = read_exact(f, 1)[0]
+                if not length:
+                    break
+                read_exact(f, length)
+        if not frames:
+            raise ImageIntegrityError('GIF 缺少图像数据')
+
+
+def verify_webp(file_path: str):
+    '''检查 WebP 的 RIFF 容器: 声明的长度与文件大小一致且各块首尾相接, 不解码像素数据'''
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        header = read_exact(f, 12)
+        if header[:4] != b'RIFF' or header[8:] != b'WEBP':
+            raise ImageIntegrityError('不是 WebP 文件')
+        if struct.unpack('<I', header[4:8])[0] + 8 != size:
+            raise ImageIntegrityError('WebP 文件不完整')
+        offset = 12
+        while offset < size:
+            f.seek(offset)
+            length = struct.unpack('<I', read_exact(f, 8)[4:])[0]
+            offset += 8 + length + (length & 1)
+        if offset != size:
+            raise ImageIntegrityError('WebP 块长度与文件大小不一致')
+
+
+# 不生成位图的检查, 内存占用与图片尺寸无关
+STREAM_VERIFIERS = {
+    'PNG': verify_png,
+    'GIF': verify_gif,
+    'WEBP': verify_webp,
+}
+
+
+def verify_image(file_path: str, budget: int | None = None):
+    '''检查图片完整性, 返回从文件头读取的尺寸, 损坏时抛出异常
+
+    PNG 流式解压并校验 CRC 与数据长度; JPEG 以 1/8 缩放完整解码一次;
+    其他格式不超过像素预算时完整解码; GIF 与 WebP 另外逐块检查文件结构, 可发现截断,
+    超过像素预算时只做该检查, 不校验像素数据; 其余格式超过预算时只做 Pillow 的文件头检查,
+    无法发现截断
+    '''
+    budget = budget or PIXEL_BUDGET
+    with Image.open(file_path) as img:
+        size = img.size
+        fmt = img.format
+        if fmt == 'JPEG':
+            img.draft(None, (1, 1))
+            img.load()
+            return size
+        if fmt != 'PNG' and size[0] * size[1] <= budget:
+            img.load()
+        elif fmt not in STREAM_VERIFIERS:
+            img.verify()
+    verifier = STREAM_VERIFIERS.get(fmt)
+    if verifier is not None:
+        verifier(file_path)
+    return size
+
+
+def decode_png_reduced(file_path: str, factor: int, budget: int):
+    '''按条带解码非隔行 PNG 并缩小 factor 倍, 每个条带的像素数不超过 budget
+
+    每个条带前加上上一条带重建后的最后一行(过滤类型为 None), 由 Pillow 的 zip 解码器还原过滤,
+    条带高度为 factor 的整数倍, 拼接结果与整图 reduce 一致; 不支持的格式返回 None
+    '''
+    with PngStream(file_path) as png:
+        mode, rawmode = PNG_MODES.get((png.color_type, png.bit_depth),
+                                      (None, None))
+        if png.interlace or mode is None:
+            return None
+        width, height = png.size
+        row_size = 1 + png.row_bytes()
+        strip_rows = max(factor, budget // width // factor * factor)
+        palette = png.ancillary.get(b'PLTE')
+        if palette is not None and b'tRNS' in png.ancillary:
+            alpha = png.ancillary[b'tRNS'].ljust(len(palette) // 3, b'\xff')
+            palette = b''.join(palette[i * 3:i * 3 + 3] + alpha[i:i + 1]
+                               for i in range(len(palette) // 3))
+        result = None
+        previous = b''
+        buffer = bytearray()
+        y = 0
+
+        def decode_strip(rows: int):
+            nonlocal previous, result
+            lead = 1 if previous else 0
+            # 不压缩的 zlib 流, 避免额外的 CPU 开销
+            compressor = zlib.compressobj(0)
+            head = b'\x00' + previous if lead else b''
+            with memoryview(buffer) as raw:
+                data = (compressor.compress(head) +
+                        compressor.compress(raw[:rows * row_size]) +
+                        compressor.flush())
+            strip = Image.frombytes(mode, (width, rows + lead), data, 'zip',
+                                    rawmode)
+            del data
+            previous = strip.crop((0, rows + lead - 1, width,
+                                   rows + lead)).tobytes('raw', rawmode)
+            if mode == 'P':
+                if len(palette) % 4 == 0 and b'tRNS' in png.ancillary:
+                    strip.putpalette(palette, 'RGBA')
+                    strip = strip.convert('RGBA')
+                else:
+                    strip.putpalette(palette, 'RGB')
+                    strip = strip.convert('RGB')
+            elif mode == '1':
+                strip = strip.convert('L')
+            strip = strip.reduce(factor, (0, lead, width, rows + lead))
+            if result is None:
+                result = Image.new(strip.mode, (math.ceil(
+                    width / factor), math.ceil(height / factor)))
+            result.paste(strip, (0, y // factor))
+
+        for data in png.iter_raw():
+            buffer += data
+            while len(buffer) >= strip_rows * row_size:
+                decode_strip(strip_rows)
+                del buffer[:strip_rows * row_size]
+                y += strip_rows
+        if buffer:
+            decode_strip(len(buffer) // row_size)
+        return result
+
+
+def decode_image(file_path: str,
+                 max_size: tuple[int, int],
+                 budget: int | None = None):
+    '''解码图片, 返回文件头中的原始尺寸与不小于 max_size 缩放尺寸的图像
+
+    JPEG 使用 draft 在解码时直接按 1/2, 1/4, 1/8 缩小, 其他格式在解码后使用 reduce;
+    像素数超过 budget 且需要缩小的 PNG 按条带解码, 不生成完整位图
+    '''
+    budget = budget or PIXEL_BUDGET
+    img = Image.open(file_path)
+    size = img.size
+    target = fit_size(size, max_size)
+    factor = min(size[0] // target[0], size[1] // target[1])
+    if (img.format == 'PNG' and size[0] * size[1] > budget and factor >= 2):
+        img.close()
+        reduced = decode_png_reduced(file_path, factor, budget)
+        if reduced is not None:
+            return size, reduced
+        img = Image.open(file_path)
+    if img.format == 'JPEG':
+        img.draft(None, target)
+    img.load()
+    factor = min(img.size[0] // target[0], img.size[1] // target[1])
+    if factor >= 2 and img.mode not in ('P', '1'):
+        img = img.reduce(factor)
+    return size, img
+
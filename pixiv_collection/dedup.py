@@ -0,0 +1,157 @@
+from PIL import Image
+
+LOSSLESS_EXTS = ('png', 'gif', 'bmp', 'tif', 'tiff')
+CONFLICT_POLICIES = ('duplicate', 'lossless', 'largest', 'filesize', 'newest',
+                     'interactive')
+DEFAULT_POLICY = ('interactive', )
+PHASH_RADIUS = 6
+
+
+def dhash(img: Image.Image, hash_size: int = 8):
+    '''差值感知哈希(dHash), 返回 hash_size * hash_size 位的十六进制字符串'''
+    gray = img.convert('L').resize((hash_size + 1, hash_size),
+                                   Image.Resampling.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col + 1] >
+                                    pixels[offset + col])
+    return f'{value:0{hash_size * hash_size // 4}x}'
+
+
+def hamming(hash1: str, hash2: str):
+    '''两个十六进制哈希的汉明距离'''
+    return (int(hash1, 16) ^ int(hash2, 16)).bit_count()
+
+
+def narrow_candidates(candidates: list[dict], policy=DEFAULT_POLICY):
+    '''按策略依次筛选冲突文件, 剩余一个或遇到 interactive 时停止
+
+    candidates 中每项包含 ext, size, filesize, mtime_ns, hash, phash;
+    duplicate: 所有文件内容哈希相同时保留第一个
+    lossless: 存在无损格式时只保留无损格式
+    largest: 保留分辨率最大的文件
+    filesize: 保留文件最大的文件
+    newest: 保留修改时间最新的文件
+    interactive: 停止自动筛选, 由用户选择
+    '''
+    for rule in policy:
+        if len(candidates) <= 1 or rule == 'interactive':
+            break
+        if rule == 'duplicate':
+            if len({c['hash'] for c in candidates}) == 1:
+                candidates = candidates[:1]
+        elif rule == 'lossless':
+            lossless = [
+                c for c in candidates if c['ext'].lower() in LOSSLESS_EXTS
+            ]
+            candidates = lossless or candidates
+        elif rule == 'largest':
+            best = max(c['size'][0] * c['size'][1] for c in candidates)
+            candidates = [
+                c for c in candidates if c['size'][0] * c['size'][1] == best
+            ]
+        elif rule == 'filesize':
+            best = max(c['filesize'] for c in candidates)
+            candidates = [c for c in candidates if c['filesize'] == best]
+        elif rule == 'newest':
+            best = max(c['mtime_ns'] for c in candidates)
+            candidates = [c for c in candidates if c['mtime_ns'] == best]
+        else:
+            raise ValueError(f'未知冲突处理策略: {rule}')
+    return candidates
+
+
+def group_by(records: dict, field: str):
+    '''按文件记录中的字段值分组, 返回包含多个文件的组 {值: [文件名]}'''
+    groups = {}
+    for filename, record in records.items():
+        value = record['data'].get(field)
+        if value is not None:
+            groups.setdefault(value, []).append(filename)
+    return {value: names for value, names in groups.items() if len(names) > 1}
+
+
+class BKTree():
+    '''感知哈希的 BK 树, 按汉明距离查询
+
+    节点为 [哈希值, 键集合, {距离: 子节点}], 删除键时保留空节点用于路由
+    '''
+
+    def __init__(self):
+        self.root = None
+        self.values = {}
+
+    def __find(self, value: int, create: bool):
+        if self.root is None:
+            if not create:
+                return None
+            self.root = [value, set(), {}]
+            return self.root
+        node = self.root
+        while True:
+            d = (node[0] ^ value).bit_count()
+            if d == 0:
+                return node
+            child = node[2].get(d)
+            if child is None:
+                if not create:
+                    return None
+                child = node[2][d] = [value, set(), {}]
+            node = child
+
+    def add(self, key: str, phash: str):
+        self.remove(key)
+        value = int(phash, 16)
+        self.values[key] = value
+        self.__find(value, True)[1].add(key)
+
+    def remove(self, key: str):
+        value = self.values.pop(key, None)
+        if value is None:
+            return
+        node = self.__find(value, False)
+        if node is not None:
+            node[1].discard(key)
+
+    def search(self, phash: str, radius: int = PHASH_RADIUS):
+        '''查询汉明距离不超过 radius 的键, 返回按距离排序的 [(键, 距离)]'''
+        if self.root is None:
+            return []
+        value = int(phash, 16)
+        result = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = (node[0] ^ value).bit_count()
+            if d <= radius:
+                result.extend((key, d) for key in node[1])
+            for dist, child in node[2].items():
+                if d - radius <= dist <= d + radius:
+                    stack.append(child)
+        result.sort(key=lambda x: (x[1], x[0]))
+        return result
+
+    def clusters(self, radius: int = PHASH_RADIUS):
+        '''将汉明距离不超过 radius 的键连通为簇, 返回包含多个键的簇列表'''
+        parent = {}
+
+        def find(key):
+            while parent.get(key, key) != key:
+                parent[key] = parent.get(parent[key], parent[key])
+                key = parent[key]
+            return key
+
+        for key, value in self.values.items():
+            for other, _ in self.search(f'{value:x}', radius):
+                a, b = find(key), find(other)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+        groups = {}
+        for key in self.values:
+            groups.setdefault(find(key), []).append(key)
+        return sorted((sorted(group) for group in groups.values()
+                       if len(group) > 1),
+                      key=lambda x: (-len(x), x[0]))
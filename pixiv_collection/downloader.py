@@ -0,0 +1,60 @@
+import os
+import re
+
+PART_SUFFIX = '.part'
+CHUNK_SIZE = 256 * 1024
+REFERER = 'https://app-api.pixiv.net/'
+
+
+class IncompleteDownload(Exception):
+    '''下载数据长度与 Content-Length 不一致'''
+
+
+def content_total(response, offset: int):
+    '''根据响应头计算文件总大小, 未知时返回 None'''
+    content_range = response.headers.get('Content-Range', '')
+    match = re.match(r'bytes (?:\d+-\d+|\*)/(\d+)', content_range)
+    if match:
+        return int(match.group(1))
+    length = response.headers.get('Content-Length')
+    if length is None:
+        return None
+    return offset + int(length)
+
+
+def fetch_resumable(request,
+                    url: str,
+                    part_path: str,
+                    referer: str = REFERER,
+                    chunk_size: int = CHUNK_SIZE):
+    '''流式下载至 part_path, 已存在的部分文件通过 HTTP Range 续传
+
+    request 为 requests 风格的调用 request(method, url, headers=, stream=),
+    连接中断时已写入的数据保留在 part_path 中供下次续传,
+    下载完成后校验文件大小与 Content-Length 一致, 返回文件大小
+    '''
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Referer': referer}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+    with request('GET', url, headers=headers, stream=True) as response:
+        if response.status_code == 416:
+            # 部分文件已完整或与服务器文件不一致
+            total = content_total(response, 0)
+            if total == offset:
+                return offset
+            os.remove(part_path)
+            raise IncompleteDownload(f'续传范围无效: {url}')
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            # 服务器不支持 Range, 从头下载
+            offset = 0
+        total = content_total(response, offset)
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        raise IncompleteDownload(f'文件大小不一致 {size}/{total}: {url}')
+    return size
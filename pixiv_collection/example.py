@@ -1,9 +1,11 @@
 from .collection import PixivCollection
+from .pipeline import Pipeline, pipeline_path
 
 PATH_ORIGINAL = './image/original/'  # 原图保存路径
 PATH_PREVIEW = './image/preview/'  # 预览图保存路径
 PATH_THUMBNAIL = './image/thumbnail/'  # 缩略图保存路径
 LOG_FILE = './logs/example_{time}.log'  # 日志文件路径
+CONFLICT_POLICY = ('duplicate', 'lossless', 'largest')  # 同一作品多个扩展名时自动选择保留的文件, 无需人工输入
 
 USER_ID = 20180111  # 用户ID
 REFRESH_TOKEN = 'xxxxxx'  # refresh_token
@@ -19,12 +21,47 @@ if not c.init(refresh_token=REFRESH_TOKEN):
     print('PixivAPI初始化失败，程序退出')
     exit(1)
 c.read_data('collection.json')
-c.download_bookmark(user_id=USER_ID, type='public', max_page=2)
-c.download_bookmark(user_id=USER_ID, type='private', max_page=2)
-c.diff()
-c.update()
-c.generate_preview()
-c.generate_thumbnail()
-c.clean()
-c.save_data('collection.json')
-c.export('images.json')
+
+# 输入没有变动的步骤会被跳过, 输出内容未变动时不重写文件
+p = Pipeline(c, pipeline_path('collection.json'))
+p.add('download_public',
+      lambda: c.download_bookmark(user_id=USER_ID, type='public', max_page=2),
+      produces=('image', 'author', 'tag'))
+p.add('download_private',
+      lambda: c.download_bookmark(user_id=USER_ID, type='private', max_page=2),
+      produces=('image', 'author', 'tag'))
+# 新增与变动的原图在 diff 读取信息时一次解码生成预览图和缩略图, 之后两步只补全缺失的文件
+p.add('diff',
+      lambda: c.diff(generate_derivatives=True,
+                     conflict_policy=CONFLICT_POLICY),
+      produces=('file', ))
+p.add('update',
+      lambda: c.update(workers=4),
+      consumes=('file', ),
+      produces=('image', 'author', 'tag'))
+p.add('refresh',
+      lambda: c.refresh(budget=100, user_id=USER_ID),
+      produces=('image', 'author', 'tag'))
+p.add('generate_preview',
+      lambda delta: c.generate_preview(files=delta and delta['file']),
+      consumes=('file', ),
+      incremental=True)
+p.add('generate_thumbnail',
+      lambda delta: c.generate_thumbnail(files=delta and delta['file']),
+      consumes=('file', ),
+      incremental=True)
+p.add('clean',
+      c.clean,
+      consumes=('file', 'image'),
+      produces=('image', 'author', 'tag'))
+p.add('save',
+      lambda: c.save_data('collection.json'),
+      consumes=('file', 'image', 'author', 'tag'),
+      outputs=('collection.json', ))
+p.add('export',
+      lambda: c.export('images.json'),
+      consumes=('file', 'image', 'author', 'tag'),
+      outputs=('images.json', ))
+p.run()
+c.metrics().log_summary()
+c.metrics().write_prometheus('pixiv_collection.prom')
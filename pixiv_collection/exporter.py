@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import time
+
+from storage import replace_if_changed
+
+DELTA_COMPACT_EVERY = 20
+
+
+def export_order(files: dict):
+    '''导出顺序: 按作品 ID 降序, 同一作品按分P升序'''
+    return sorted(files,
+                  key=lambda x: (-files[x]['data']['id'], files[x]['data'][
+                      'part']))
+
+
+def iter_records(authors: dict,
+                 images: dict,
+                 tags: dict,
+                 files: dict,
+                 filter_max_sl: int = -1,
+                 exclude_author: set = frozenset(),
+                 exclude_illust: set = frozenset(),
+                 order=None,
+                 with_version=False):
+    '''按导出顺序逐条生成导出记录
+
+    同一作品的多个分P共用一次作品、作者与标签的连接结果;
+    with_version 为 True 时生成 (记录, 版本), 版本为文件、作品、作者与标签中最新的 update 时间戳
+    '''
+    joined = {}
+    for filename in (export_order(files) if order is None else order):
+        file = files[filename]['data']
+        image_id = str(file['id'])
+        common = joined.get(image_id)
+        if common is None:
+            image = images.get(image_id, {}).get('data')
+            if image is None or str(image['author_id']) not in authors or any(
+                    tag not in tags for tag in image['tags']):
+                # 尚未获取作品信息, 或作者、标签不完整的文件不导出, 由 update 重新获取
+                common = False
+            elif (filter_max_sl != -1 and image['sanity_level'] > filter_max_sl
+                  ) or image['author_id'] in exclude_author or image[
+                      'id'] in exclude_illust:
+                common = False
+            else:
+                author = authors[str(image['author_id'])]
+                common = (
+                    image['title'],
+                    author['data'],
+                    [tags[tag]['data'] for tag in image['tags']],
+                    image,
+                    max([images[image_id]['update'], author['update']] +
+                        [tags[tag]['update'] for tag in image['tags']]),
+                )
+            joined[image_id] = common
+        if common is False:
+            continue
+        title, author, image_tags, image, version = common
+        record = {
+            'id': file['id'],
+            'part': file['part'],
+            'title': title,
+            'size': file['size'],
+            'ext': file['ext'],
+            'author': author,
+            'tags': image_tags,
+            'created_at': image['created_at'],
+            'sanity_level': image['sanity_level'],
+            'x_restrict': image['x_restrict'],
+            'bookmark': image['bookmark'],
+            'view': image['view'],
+            'dominant_color': file['dominant_color'],
+            'palette': file.get('palette'),
+            'blurhash': file.get('blurhash'),
+        }
+        if with_version:
+            yield record, max(version, files[filename]['update'])
+        else:
+            yield record
+
+
+class JsonArrayWriter():
+    '''逐条写入 JSON 数组, 输出与 json.dump(list, ensure_ascii=False) 一致
+
+    先写入临时文件, 关闭时内容与原文件不同才替换, changed 表示是否替换
+    '''
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.count = 0
+        self.changed = False
+        self.__file = open(file_path + '.tmp', 'w', encoding='utf-8')
+        self.__file.write('[')
+
+    def write(self, record: dict):
+        if self.count:
+            self.__file.write(', ')
+        self.__file.write(json.dumps(record, ensure_ascii=False))
+        self.count += 1
+
+    def close(self):
+        self.__file.write(']')
+        self.__file.close()
+        self.changed = replace_if_changed(self.__file.name, self.file_path)
+
+    def discard(self):
+        '''放弃写入, 保留原文件'''
+        self.__file.close()
+        os.remove(self.__file.name)
+
+
+def shard_path(file_path: str, index: int):
+    base, ext = os.path.splitext(file_path)
+    return f'{base}.{index}{ext}'
+
+
+def manifest_path(file_path: str):
+    base, ext = os.path.splitext(file_path)
+    return f'{base}.manifest{ext}'
+
+
+def write_export(file_path: str, records, shard_size: int | None = None):
+    '''流式写入导出文件
+
+    shard_size 不为 None 时, 同时按每 shard_size 条记录写入分片文件 images.0.json, images.1.json ...
+    以及清单 images.manifest.json, 供前端按页加载; 内容未变动的文件不会被重写;
+    返回 (记录总数, 导出文件是否被重写)
+    '''
+    writer = JsonArrayWriter(file_path)
+    shards = []
+    shard = None
+    try:
+        for record in records:
+            writer.write(record)
+            if shard_size:
+                if shard is None or shard.count >= shard_size:
+                    if shard is not None:
+                        shard.close()
+                    shard = JsonArrayWriter(
+                        shard_path(file_path, len(shards)))
+                    shards.append({
+                        'file': os.path.basename(shard.file_path),
+                        'first': [record['id'], record['part']],
+                    })
+                shard.write(record)
+                shards[-1]['count'] = shard.count
+                shards[-1]['last'] = [record['id'], record['part']]
+    except BaseException:
+        # 中途失败时保留上次导出的文件
+        writer.discard()
+        if shard is not None:
+            shard.discard()
+        raise
+    writer.close()
+    if shard is not None:
+        shard.close()
+    if shard_size:
+        # 删除上次导出遗留的多余分片
+        index = len(shards)
+        while os.path.exists(shard_path(file_path, index)):
+            os.remove(shard_path(file_path, index))
+            index += 1
+        tmp_path = manifest_path(file_path) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(
+                {
+                    'total': writer.count,
+                    'shard_size': shard_size,
+                    'shards': shards,
+                },
+                f,
+                ensure_ascii=False)
+        replace_if_changed(tmp_path, manifest_path(file_path))
+    return writer.count, writer.changed
+
+
+def delta_path(file_path: str, generation: int):
+    base, ext = os.path.splitext(file_path)
+    return f'{base}.delta.{generation}{ext}'
+
+
+def version_path(file_path: str):
+    base, ext = os.path.splitext(file_path)
+    return f'{base}.version{ext}'
+
+
+def state_path(file_path: str):
+    base, ext = os.path.splitext(file_path)
+    return f'{base}.state{ext}'
+
+
+def record_digest(record: dict):
+    return hashlib.blake2b(json.dumps(record, ensure_ascii=False).encode(),
+                           digest_size=8).hexdigest()
+
+
+def write_delta_export(file_path: str,
+                       records,
+                       compact_every: int = DELTA_COMPACT_EVERY,
+                       shard_size: int | None = None):
+    '''增量导出
+
+    records 为 (记录, 版本) 序列; 与上次导出相比, 版本早于上次导出时间的记录视为未变动,
+    其余记录比较摘要, 生成补丁 images.delta.<代>.json (added/updated/removed);
+    首次导出或距上次全量导出满 compact_every 代时同时全量写入 file_path 并清理旧补丁, 没有变动时不写入任何文件;
+    images.version.json 供客户端获取当前代数与可用补丁, images.state.json 保存各记录摘要
+    '''
+    state = {'generation': 0, 'snapshot': 0, 'exported_at': 0, 'records': {}}
+    if os.path.exists(state_path(file_path)):
+        with open(state_path(file_path), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    generation = state['generation'] + 1
+    compact = (not state['records'] or not os.path.exists(file_path)
+               or generation - state['snapshot'] >= compact_every)
+    exported_at = int(time.time())
+    previous = state['records']
+    current = {}
+    added = []
+    updated = []
+
+    def tracked():
+        for record, version in records:
+            key = f'{record["id"]}_{record["part"]}'
+            digest = previous.get(key)
+            if digest is not None and version < state['exported_at']:
+                current[key] = digest
+            else:
+                current[key] = record_digest(record)
+                if digest is None:
+                    added.append(record)
+                elif digest != current[key]:
+                    updated.append(record)
+            yield record
+
+    if compact:
+        write_export(file_path, tracked(), shard_size)
+    else:
+        for _ in tracked():
+            pass
+    removed = [[int(i) for i in key.split('_')] for key in previous
+               if key not in current]
+    if not compact and not (added or updated or removed):
+        # 没有变动时不生成新的一代, 客户端无需更新
+        return {
+            'generation': state['generation'],
+            'snapshot': False,
+            'added': 0,
+            'updated': 0,
+            'removed': 0,
+        }
+
+    with open(delta_path(file_path, generation), 'w', encoding='utf-8') as f:
+        json.dump(
+            {
+                'generation': generation,
+                'base': generation - 1,
+                'added': added,
+                'updated': updated,
+                'removed': removed,
+            },
+            f,
+            ensure_ascii=False)
+    snapshot = state['snapshot']
+    first_delta = max(snapshot, 1)
+    if compact:
+        # 全量快照已包含之前的所有变动, 只保留本代补丁供上一代客户端使用
+        for g in range(first_delta, generation):
+            if os.path.exists(delta_path(file_path, g)):
+                os.remove(delta_path(file_path, g))
+        snapshot = generation
+        first_delta = generation
+    with open(version_path(file_path), 'w', encoding='utf-8') as f:
+        json.dump(
+            {
+                'generation':
+                generation,
+                'snapshot':
+                snapshot,
+                'deltas': [{
+                    'generation': g,
+                    'file': os.path.basename(delta_path(file_path, g)),
+                } for g in range(first_delta, generation + 1)],
+            },
+            f,
+            ensure_ascii=False)
+    tmp_path = state_path(file_path) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(
+            {
+                'generation': generation,
+                'snapshot': snapshot,
+                'exported_at': exported_at,
+                'records': current,
+            }, f)
+    os.replace(tmp_path, state_path(file_path))
+    return {
+        'generation': generation,
+        'snapshot': compact,
+        'added': len(added),
+        'updated': len(updated),
+        'removed': len(removed),
+    }
@@ -0,0 +1,253 @@
+import heapq
+import math
+
+from dedup import BKTree
+
+COLOR_CELL_SIZE = 10
+
+
+def hex2lab(color: str):
+    '''#rrggbb 转换为 CIELAB (D65)'''
+    value = int(color.lstrip('#'), 16)
+    rgb = [(value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff]
+    linear = []
+    for c in rgb:
+        c /= 255
+        linear.append(c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055)**2.4)
+    r, g, b = linear
+    x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883
+
+    def f(t):
+        return t**(1 / 3) if t > 0.008856 else 7.787 * t + 16 / 116
+
+    fx, fy, fz = f(x), f(y), f(z)
+    return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+
+class ColorIndex():
+    '''主色调的近似颜色索引
+
+    将颜色转换至 CIELAB 后按 cell_size 划分网格, 距离为 CIE76 ΔE (Lab 欧氏距离),
+    查询只访问查询点附近的网格
+    '''
+
+    def __init__(self, cell_size: float = COLOR_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.points = {}
+
+    def __cell(self, lab):
+        return tuple(math.floor(v / self.cell_size) for v in lab)
+
+    def add(self, key: str, color: str):
+        self.remove(key)
+        lab = hex2lab(color)
+        self.points[key] = lab
+        self.cells.setdefault(self.__cell(lab), set()).add(key)
+
+    def remove(self, key: str):
+        lab = self.points.pop(key, None)
+        if lab is None:
+            return
+        cell = self.__cell(lab)
+        self.cells[cell].discard(key)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def __shell(self, center, radius: int):
+        '''与中心网格切比雪夫距离恰为 radius 的网格'''
+        ci, cj, ck = center
+        for i in range(ci - radius, ci + radius + 1):
+            for j in range(cj - radius, cj + radius + 1):
+                edge = abs(i - ci) == radius or abs(j - cj) == radius
+                step = 1 if edge else 2 * radius
+                for k in range(ck - radius, ck + radius + 1, step or 1):
+                    cell = self.cells.get((i, j, k))
+                    if cell:
+                        yield cell
+
+    def within(self, color: str, delta_e: float):
+        '''查询 ΔE 不超过 delta_e 的颜色, 返回按距离排序的 [(键, ΔE)]'''
+        lab = hex2lab(color)
+        center = self.__cell(lab)
+        result = []
+        for radius in range(math.ceil(delta_e / self.cell_size) + 1):
+            for cell in self.__shell(center, radius):
+                for key in cell:
+                    d = math.dist(lab, self.points[key])
+                    if d <= delta_e:
+                        result.append((key, d))
+        result.sort(key=lambda x: (x[1], x[0]))
+        return result
+
+    def nearest(self, color: str, k: int = 10):
+        '''查询最接近的 k 个颜色, 返回按距离排序的 [(键, ΔE)]'''
+        lab = hex2lab(color)
+        center = self.__cell(lab)
+        heap = []
+        # Lab 取值范围有限, 超过该半径后不会再有网格
+        max_radius = math.ceil(400 / self.cell_size) + 1
+        for radius in range(max_radius + 1):
+            for cell in self.__shell(center, radius):
+                for key in cell:
+                    item = (-math.dist(lab, self.points[key]), key)
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+            # 已访问的网格覆盖了半径 radius * cell_size 内的全部颜色
+            if len(heap) >= k and -heap[0][0] <= radius * self.cell_size:
+                break
+            if len(heap) == len(self.points):
+                break
+        return sorted(((key, -d) for d, key in heap),
+                      key=lambda x: (x[1], x[0]))
+
+
+class CollectionIndex():
+    '''收藏数据的倒排索引
+
+    维护 标签 -> 作品, 作者 -> 作品, 限制级别 -> 作品, 作品 -> 文件, 内容哈希 -> 文件 的映射,
+    以及文件主色调索引与感知哈希 BK 树, 并记录可能失去引用的作品、作者与标签, 供 clean 只检查变动部分
+    '''
+
+    def __init__(self):
+        self.tag_images = {}
+        self.author_images = {}
+        self.sl_images = {}
+        self.image_files = {}
+        self.hash_files = {}
+        self.colors = ColorIndex()
+        self.phashes = BKTree()
+        self.orphans = {'image': set(), 'author': set(), 'tag': set()}
+
+    @staticmethod
+    def __add(index: dict, key, value):
+        index.setdefault(key, set()).add(value)
+
+    @staticmethod
+    def __remove(index: dict, key, value):
+        '''移除映射, 返回该键是否已无引用'''
+        values = index.get(key)
+        if values is None:
+            return True
+        values.discard(value)
+        if not values:
+            del index[key]
+            return True
+        return False
+
+    def build(self, images: dict, files: dict, authors: dict, tags: dict):
+        '''根据全部数据重建索引'''
+        self.tag_images = {}
+        self.author_images = {}
+        self.sl_images = {}
+        self.image_files = {}
+        self.hash_files = {}
+        self.colors = ColorIndex()
+        self.phashes = BKTree()
+        for filename, file in files.items():
+            self.update('file', filename, None, file['data'])
+        for image_id, image in images.items():
+            self.update('image', image_id, None, image['data'])
+        self.orphans['image'] = set(images) - set(self.image_files)
+        self.orphans['author'] = set(authors) - set(self.author_images)
+        self.orphans['tag'] = set(tags) - set(self.tag_images)
+
+    def update(self, type: str, key: str, old: dict | None, new: dict | None):
+        '''记录数据变动, old 为变动前数据, new 为变动后数据, 删除时 new 为 None'''
+        if type == 'file':
+            if old is not None and self.__remove(self.image_files,
+                                                 str(old['id']), key):
+                self.orphans['image'].add(str(old['id']))
+            if new is not None:
+                self.__add(self.image_files, str(new['id']), key)
+            if new is not None and new.get('dominant_color'):
+                self.colors.add(key, new['dominant_color'])
+            else:
+                self.colors.remove(key)
+            if old is not None and old.get('hash'):
+                self.__remove(self.hash_files, old['hash'], key)
+            if new is not None and new.get('hash'):
+                self.__add(self.hash_files, new['hash'], key)
+            if new is not None and new.get('phash'):
+                self.phashes.add(key, new['phash'])
+            else:
+                self.phashes.remove(key)
+        elif type == 'image':
+            if old is not None:
+                if self.__remove(self.author_images, str(old['author_id']),
+                                 key):
+                    self.orphans['author'].add(str(old['author_id']))
+                for tag in old['tags']:
+                    if self.__remove(self.tag_images, tag, key):
+                        self.orphans['tag'].add(tag)
+                self.__remove(self.sl_images, old['sanity_level'], key)
+            if new is not None:
+                self.__add(self.author_images, str(new['author_id']), key)
+                for tag in new['tags']:
+                    self.__add(self.tag_images, tag, key)
+                self.__add(self.sl_images, new['sanity_level'], key)
+                if key not in self.image_files:
+                    self.orphans['image'].add(key)
+        elif type == 'author':
+            if new is not None and key not in self.author_images:
+                self.orphans['author'].add(key)
+        elif type == 'tag':
+            if new is not None and key not in self.tag_images:
+                self.orphans['tag'].add(key)
+
+    def take_orphans(self, type: str):
+        '''取出并清空可能失去引用的键, 返回其中确实已无引用的键'''
+        candidates = self.orphans[type]
+        self.orphans[type] = set()
+        index = {
+            'image': self.image_files,
+            'author': self.author_images,
+            'tag': self.tag_images,
+        }[type]
+        return sorted(key for key in candidates if key not in index)
+
+    def match(self,
+              tags: list[str] | None = None,
+              any_tags: list[str] | None = None,
+              authors: list[int | str] | None = None,
+              max_sl: int = -1,
+              exclude_authors: list[int | str] = (),
+              exclude_illusts: list[int | str] = (),
+              exclude_tags: list[str] = ()):
+        '''按条件筛选作品, 返回作品 ID 集合
+
+        tags 要求包含全部标签, any_tags 要求包含任一标签, authors 限定作者,
+        max_sl 为最大限制级别(-1 不限制)
+        '''
+        result = None
+
+        def intersect(ids):
+            nonlocal result
+            result = set(ids) if result is None else result & ids
+
+        for tag in tags or ():
+            intersect(self.tag_images.get(tag, set()))
+        if any_tags is not None:
+            intersect(
+                set().union(*(self.tag_images.get(tag, set())
+                              for tag in any_tags)))
+        if authors is not None:
+            intersect(
+                set().union(*(self.author_images.get(str(author), set())
+                              for author in authors)))
+        if max_sl != -1:
+            intersect(
+                set().union(*(ids for sl, ids in self.sl_images.items()
+                              if sl <= max_sl)))
+        if result is None:
+            result = set(self.image_files)
+        for author in exclude_authors:
+            result -= self.author_images.get(str(author), set())
+        for tag in exclude_tags:
+            result -= self.tag_images.get(tag, set())
+        result -= {str(i) for i in exclude_illusts}
+        return result
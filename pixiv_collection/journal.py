@@ -0,0 +1,146 @@
+import atexit
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from storage import TABLES
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_FLUSH_EVERY = 50
+JOURNAL_FLUSH_INTERVAL = 5
+JOURNAL_CHECKPOINT_EVERY = 5000
+
+
+def journal_path(file_path: str):
+    return file_path + JOURNAL_SUFFIX
+
+
+class Journal():
+    '''数据变动的追加式日志, 与数据文件一一对应
+
+    每行为一个 JSON 对象: {"op": "set"/"del", "table": 表名, "key": 键, "record": 记录},
+    或 {"op": "watermark", "key": 键, "value": 水位线};
+    group 中追加的多条合并为一行 {"op": "group", "entries": [...]}, 重放时全部应用或全部忽略;
+    缓冲 flush_every 条或距上次写入超过 flush_interval 秒后写入并 fsync, 进程退出时写入剩余部分
+    '''
+
+    def __init__(self,
+                 file_path: str,
+                 flush_every: int = JOURNAL_FLUSH_EVERY,
+                 flush_interval: float = JOURNAL_FLUSH_INTERVAL):
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.entries = 0
+        self.__buffer = []
+        self.__group = []
+        self.__depth = 0
+        self.__last_flush = time.monotonic()
+        self.__file = None
+        atexit.register(self.flush)
+
+    @property
+    def in_group(self):
+        return self.__depth > 0
+
+    @contextmanager
+    def group(self):
+        '''其中追加的条目在结束时作为一行写入, 写入中途崩溃时整组丢弃; 可嵌套, 以最外层为准'''
+        self.__depth += 1
+        try:
+            yield
+        finally:
+            self.__depth -= 1
+            if not self.__depth and self.__group:
+                entries, self.__group = self.__group, []
+                self.__write(entries[0] if len(entries) == 1 else {
+                    'op': 'group',
+                    'entries': entries
+                }, len(entries))
+
+    def append(self, entry: dict):
+        if self.__depth:
+            self.__group.append(entry)
+            return
+        self.__write(entry, 1)
+
+    def __write(self, entry: dict, count: int):
+        self.__buffer.append(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.entries += count
+        if len(self.__buffer) >= self.flush_every or time.monotonic(
+        ) - self.__last_flush >= self.flush_interval:
+            self.flush()
+
+    def set(self, table: str, key: str, record: dict):
+        self.append({'op': 'set', 'table': table, 'key': key, 'record': record})
+
+    def delete(self, table: str, key: str):
+        self.append({'op': 'del', 'table': table, 'key': key})
+
+    def watermark(self, key: str, value: list):
+        self.append({'op': 'watermark', 'key': key, 'value': value})
+
+    def flush(self):
+        self.__last_flush = time.monotonic()
+        if not self.__buffer:
+            return
+        if self.__file is None:
+            self.__file = open(self.file_path, 'a', encoding='utf-8')
+        self.__file.write(''.join(self.__buffer))
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__buffer = []
+
+    def replay(self, data: dict):
+        '''将日志中的变动应用到 data, 返回 {表名: 变动的键集合}
+
+        最后一行写入不完整时(写入过程中崩溃)忽略该行, 其中的一组变动全部不应用
+        '''
+        changes = {table: set() for table in TABLES}
+        if not os.path.exists(self.file_path):
+            return changes
+        valid = 0
+        with open(self.file_path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                valid += len(line)
+                for entry in (entry['entries']
+                              if entry['op'] == 'group' else (entry, )):
+                    self.entries += 1
+                    if entry['op'] == 'watermark':
+                        data['watermarks'][entry['key']] = entry['value']
+                        continue
+                    table, key = entry['table'], entry['key']
+                    if entry['op'] == 'set':
+                        data[table][key] = entry['record']
+                    else:
+                        data[table].pop(key, None)
+                    changes[table].add(key)
+        if valid != os.path.getsize(self.file_path):
+            # 截断不完整的行, 避免之后追加的内容与其拼接
+            os.truncate(self.file_path, valid)
+        return changes
+
+    def truncate(self):
+        '''数据已完整保存, 清空日志'''
+        self.__buffer = []
+        self.__group = []
+        self.entries = 0
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def close(self):
+        self.flush()
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        atexit.unregister(self.flush)
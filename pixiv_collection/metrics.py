@@ -0,0 +1,198 @@
+import math
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+METRICS_PREFIX = 'pixiv_collection'
+METRICS_MAX_SAMPLES = 10000
+METRICS_QUANTILES = (0.5, 0.95)
+
+
+def quantile(samples: list[float], q: float):
+    '''最近秩法计算分位数, samples 需已排序'''
+    if not samples:
+        return None
+    rank = math.ceil(q * len(samples)) - 1
+    return samples[min(len(samples) - 1, max(0, rank))]
+
+
+def format_value(value: float):
+    '''整数原样输出, 避免字节数等较大的计数被科学计数法截断'''
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def format_labels(labels: tuple, extra: tuple = ()):
+    '''标签格式化为 Prometheus 文本格式 {a="1",b="2"}, 没有标签时为空字符串'''
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"'
+                          for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+class Timing():
+    '''单个计时序列, 次数、总和与最大值精确记录, 分位数由最多 max_samples 个蓄水池样本估计'''
+
+    def __init__(self, max_samples: int = METRICS_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, value: float, rng: random.Random):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            i = rng.randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = value
+
+    def stats(self):
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': round(quantile(samples, 0.5), 6),
+            'p95': round(quantile(samples, 0.95), 6),
+            'max': round(self.max, 6),
+        }
+
+
+class Metrics():
+    '''运行指标, 包括计数器与计时器, 以名称和标签区分序列
+
+    inc / observe / timer 可在多个线程中调用; add_hook 注册的回调在每次记录时以
+    (类型 'counter' / 'timer', 名称, 值, 标签字典) 调用, 用于输出至自定义位置;
+    进程池中的工作进程不共享实例, 需由主进程根据返回结果记录
+    '''
+
+    def __init__(self, max_samples: int = METRICS_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.started_at = time.time()
+        self.counters = {}
+        self.timings = {}
+        self.__hooks = []
+        self.__lock = threading.Lock()
+        self.__random = random.Random(0)
+
+    def add_hook(self, callback):
+        self.__hooks.append(callback)
+
+    def remove_hook(self, callback):
+        self.__hooks.remove(callback)
+
+    def __emit(self, kind: str, name: str, value: float, labels: dict):
+        for hook in self.__hooks:
+            try:
+                hook(kind, name, value, labels)
+            except Exception as e:
+                # 回调出错不影响主流程
+                logger.exception(e)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        '''计数器 name 增加 value'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.__emit('counter', name, value, labels)
+
+    def observe(self, name: str, seconds: float, **labels):
+        '''记录一次耗时(秒)'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = Timing(self.max_samples)
+            timing.add(seconds, self.__random)
+        self.__emit('timer', name, seconds, labels)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        '''记录代码块的耗时, 抛出异常时同样记录'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.__lock:
+            self.counters = {}
+            self.timings = {}
+            self.started_at = time.time()
+
+    def summary(self):
+        '''返回 {'counters': {序列: 值}, 'timers': {序列: {count, sum, p50, p95, max}}}, 序列为 名称{标签}'''
+        with self.__lock:
+            return {
+                'counters': {
+                    name + format_labels(labels): value
+                    for (name, labels), value in sorted(self.counters.items())
+                },
+                'timers': {
+                    name + format_labels(labels): timing.stats()
+                    for (name, labels), timing in sorted(self.timings.items())
+                },
+            }
+
+    def log_summary(self):
+        '''输出本次运行的汇总: 各计时序列的次数、总耗时与 p50/p95, 以及计数器'''
+        summary = self.summary()
+        logger.info(f'运行指标汇总, 运行时间 {time.time() - self.started_at:.1f}s')
+        for series, stats in summary['timers'].items():
+            logger.info(f'{series}: 次数:{stats["count"]} 总计:{stats["sum"]:.2f}s '
+                        f'p50:{stats["p50"] * 1000:.1f}ms '
+                        f'p95:{stats["p95"] * 1000:.1f}ms '
+                        f'最大:{stats["max"] * 1000:.1f}ms')
+        for series, value in summary['counters'].items():
+            logger.info(f'{series}: {format_value(value)}')
+
+    def prometheus(self):
+        '''Prometheus 文本格式: 计数器为 <前缀>_<名称>_total, 计时器为 <前缀>_<名称>_seconds 摘要'''
+        lines = []
+        with self.__lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f'{METRICS_PREFIX}_{name}_total'
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} counter')
+            lines.append(
+                f'{metric}{format_labels(labels)} {format_value(value)}')
+        for (name, labels), timing in timings:
+            metric = f'{METRICS_PREFIX}_{name}_seconds'
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} summary')
+            samples = sorted(timing.samples)
+            for q in METRICS_QUANTILES:
+                lines.append(
+                    f'{metric}{format_labels(labels, (("quantile", q), ))} '
+                    f'{format_value(quantile(samples, q))}')
+            lines.append(f'{metric}_sum{format_labels(labels)} '
+                         f'{format_value(timing.sum)}')
+            lines.append(
+                f'{metric}_count{format_labels(labels)} {timing.count}')
+        metric = f'{METRICS_PREFIX}_last_run_timestamp_seconds'
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric} {time.time():.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path: str):
+        '''写入 node_exporter textfile collector 读取的 .prom 文件, 先写临时文件再原子重命名'''
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, file_path)
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+
+from loguru import logger
+
+PIPELINE_SUFFIX = '.pipeline'
+
+
+def pipeline_path(file_path: str):
+    return file_path + PIPELINE_SUFFIX
+
+
+class Stage():
+    '''流水线中的一个步骤
+
+    consumes 为读取的数据类型(file/image/author/tag), 为空时视为数据源, 每次都执行;
+    produces 为写入的数据类型, 仅用于输出变动统计; outputs 为生成的文件, 任一文件不存在时强制执行;
+    incremental 为 True 时以输入变动 {类型: 键集合} 调用 run, 无法确定变动范围时传入 None;
+    run 返回非空的列表或集合(如获取失败的作品、生成失败的文件)时视为有未完成的工作, 下次完整执行
+    '''
+
+    def __init__(self,
+                 name: str,
+                 run,
+                 consumes: tuple[str, ...] = (),
+                 produces: tuple[str, ...] = (),
+                 outputs: tuple[str, ...] = (),
+                 incremental: bool = False):
+        self.name = name
+        self.run = run
+        self.consumes = tuple(consumes)
+        self.produces = tuple(produces)
+        self.outputs = tuple(outputs)
+        self.incremental = incremental
+
+
+class Pipeline():
+    '''按顺序执行 PixivCollection 的各个步骤, 输入没有变动的步骤跳过
+
+    同一进程中步骤的输入变动由 collection.changes 得到, 即上次执行以来(首次为读取数据以来)
+    所读取数据类型中变动的键; 首次执行时还会比较 state_path 中保存的上次成功执行后的输入摘要,
+    摘要不同(如上次运行中断, 或数据被其他程序修改)时完整执行;
+    步骤执行后其输入又被之后的步骤修改, 或步骤留有未完成的工作时不保存摘要, 下次运行时重新执行
+    '''
+
+    def __init__(self, collection, state_path: str | None = None):
+        self.collection = collection
+        self.state_path = state_path
+        self.stages = []
+        self.__marks = {}
+        self.__state = {}
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                self.__state = json.load(f)
+
+    def add(self,
+            name: str,
+            run,
+            consumes: tuple[str, ...] = (),
+            produces: tuple[str, ...] = (),
+            outputs: tuple[str, ...] = (),
+            incremental: bool = False):
+        '''添加步骤, 参数见 Stage, 返回自身以便链式调用'''
+        self.stages.append(
+            Stage(name, run, consumes, produces, outputs, incremental))
+        return self
+
+    def __fingerprint(self, stage: Stage):
+        return {
+            type: self.collection.fingerprint(type)
+            for type in stage.consumes
+        }
+
+    def __delta(self, stage: Stage, since: int):
+        _, changes = self.collection.changes(since)
+        return {type: changes[type] for type in stage.consumes if changes[type]}
+
+    def __pending(self, stage: Stage):
+        '''返回 (是否执行, 输入变动), 输入变动为 None 表示需要完整执行'''
+        if not stage.consumes:
+            return True, None
+        if any(not os.path.exists(path) for path in stage.outputs):
+            return True, None
+        mark = self.__marks.get(stage.name)
+        delta = self.__delta(stage, mark or 0)
+        if mark is None and self.__state.get(
+                stage.name) != self.__fingerprint(stage):
+            return True, None
+        return bool(delta), delta
+
+    def __save_state(self):
+        if self.state_path is None:
+            return
+        state = {}
+        for stage in self.stages:
+            mark = self.__marks.get(stage.name)
+            if mark is None:
+                if stage.name in self.__state:
+                    state[stage.name] = self.__state[stage.name]
+            elif not self.__delta(stage, mark):
+                state[stage.name] = self.__fingerprint(stage)
+        self.__state = state
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def run(self, force: bool = False):
+        '''依次执行所有步骤, force 为 True 时不跳过; 返回 {步骤名: 'run' / 'skip'}
+
+        步骤抛出异常时保存已完成步骤的状态后停止, 该步骤下次运行时完整执行
+        '''
+        result = {}
+        try:
+            for stage in self.stages:
+                execute, delta = (True, None) if force else self.__pending(stage)
+                if not execute:
+                    logger.info(f'跳过步骤: {stage.name}, 输入没有变动')
+                    self.__marks[stage.name] = self.collection.changes()[0]
+                    result[stage.name] = 'skip'
+                    continue
+                if delta:
+                    logger.info(f'执行步骤: {stage.name}, 输入变动: ' + ' '.join(
+                        f'{type}:{len(keys)}' for type, keys in delta.items()))
+                else:
+                    logger.info(f'执行步骤: {stage.name}')
+                start = time.perf_counter()
+                before = self.collection.changes()[0]
+                self.__marks.pop(stage.name, None)
+                self.__state.pop(stage.name, None)
+                if stage.incremental:
+                    leftover = stage.run(delta)
+                else:
+                    leftover = stage.run()
+                self.collection.metrics().observe('stage',
+                                                  time.perf_counter() - start,
+                                                  stage=stage.name)
+                revision, changes = self.collection.changes(before)
+                result[stage.name] = 'run'
+                if isinstance(leftover, (list, set)) and leftover:
+                    # 不记录执行位置, 之后的运行中完整执行以重试失败的部分
+                    logger.warning(
+                        f'步骤未全部完成: {stage.name}, 剩余{len(leftover)}项, 下次运行时重试')
+                else:
+                    self.__marks[stage.name] = revision
+                produced = ' '.join(f'{type}:{len(changes[type])}'
+                                    for type in stage.produces
+                                    if changes[type])
+                logger.info(
+                    f'步骤完成: {stage.name}, 耗时 {time.perf_counter() - start:.2f}s'
+                    + (f', 输出变动: {produced}' if produced else ''))
+        finally:
+            self.__save_state()
+        return result
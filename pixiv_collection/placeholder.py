@@ -0,0 +1,96 @@
+import numpy as np
+from PIL import Image
+
+BLURHASH_COMPONENTS = (4, 3)
+PLACEHOLDER_SIZE = (80, 80)
+BASE83 = ('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+          '#$%*+,-.:;=?@[]^_{|}~')
+
+_SRGB_TO_LINEAR = np.array([
+    v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055)**2.4
+    for v in np.arange(256) / 255
+])
+
+
+def encode83(value: int, length: int):
+    result = ''
+    for i in range(1, length + 1):
+        result += BASE83[(value // 83**(length - i)) % 83]
+    return result
+
+
+def linear_to_srgb(value: float):
+    v = min(max(value, 0), 1)
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v**(1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def placeholder_pixels(img: Image.Image):
+    '''转换为用于计算占位图的 RGB 数组, 透明部分合成至白色背景'''
+    if img.size != PLACEHOLDER_SIZE:
+        img = img.resize(PLACEHOLDER_SIZE)
+    if img.mode != 'RGB':
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, 'white')
+        img.paste(rgba, rgba.split()[-1])
+    return np.asarray(img, dtype=np.uint8)
+
+
+def blurhash_factors(pixels: np.ndarray,
+                     components: tuple[int, int] = BLURHASH_COMPONENTS):
+    '''批量计算 BlurHash 的 DCT 系数
+
+    pixels 为 (n, h, w, 3) 的 uint8 数组, 返回 (n, cy * cx, 3), 顺序与 BlurHash 参考实现一致
+    '''
+    cx, cy = components
+    n, h, w, _ = pixels.shape
+    linear = _SRGB_TO_LINEAR[pixels]
+    basis_x = np.cos(np.pi * np.outer(np.arange(cx), np.arange(w)) / w)
+    basis_y = np.cos(np.pi * np.outer(np.arange(cy), np.arange(h)) / h)
+    factors = np.einsum('jy,ix,nyxc->njic', basis_y, basis_x, linear)
+    norm = np.full((cy, cx), 2.0)
+    norm[0, 0] = 1.0
+    factors *= norm[None, :, :, None] / (w * h)
+    return factors.reshape(n, cy * cx, 3)
+
+
+def encode_factors(factors: np.ndarray,
+                   components: tuple[int, int] = BLURHASH_COMPONENTS):
+    '''将单张图片的 DCT 系数编码为 BlurHash 字符串'''
+    cx, cy = components
+    dc, ac = factors[0], factors[1:]
+    result = encode83((cx - 1) + (cy - 1) * 9, 1)
+    if len(ac):
+        actual_max = float(np.abs(ac).max())
+        quantised_max = int(max(0, min(82, int(actual_max * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+        result += encode83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += encode83(0, 1)
+    r, g, b = (linear_to_srgb(float(v)) for v in dc)
+    result += encode83((r << 16) + (g << 8) + b, 4)
+    quant = np.floor(
+        np.clip(
+            np.sign(ac) * np.sqrt(np.abs(ac / max_value)) * 9 + 9.5, 0,
+            18)).astype(int)
+    for qr, qg, qb in quant:
+        result += encode83(int(qr) * 19 * 19 + int(qg) * 19 + int(qb), 2)
+    return result
+
+
+def blurhash_encode_batch(images: list[Image.Image],
+                          components: tuple[int, int] = BLURHASH_COMPONENTS):
+    '''批量生成 BlurHash, 所有图片缩放至 80x80 后一次完成 DCT'''
+    if not images:
+        return []
+    pixels = np.stack([placeholder_pixels(img) for img in images])
+    factors = blurhash_factors(pixels, components)
+    return [encode_factors(f, components) for f in factors]
+
+
+def blurhash_encode(img: Image.Image,
+                    components: tuple[int, int] = BLURHASH_COMPONENTS):
+    '''生成单张图片的 BlurHash'''
+    return blurhash_encode_batch([img], components)[0]
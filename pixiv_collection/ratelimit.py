@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+
+class TokenBucket():
+    '''令牌桶限速器, 多线程共享
+
+    rate 为每秒补充的令牌数, capacity 为桶容量(允许的突发请求数)
+    '''
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity,
+                            self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    def set_rate(self, rate: float, capacity: float | None = None):
+        '''调整速率'''
+        with self.__lock:
+            self.__refill()
+            self.rate = rate
+            if capacity is not None:
+                self.capacity = capacity
+                self.__tokens = min(self.__tokens, capacity)
+
+    def acquire(self, tokens: float = 1):
+        '''获取令牌, 令牌不足时阻塞等待'''
+        while True:
+            with self.__lock:
+                self.__refill()
+                if self.__tokens >= tokens:
+                    self.__tokens -= tokens
+                    return
+                wait = (tokens - self.__tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        '''记录一次成功的请求, 固定速率时忽略'''
+
+    def throttled(self):
+        '''记录一次被限流的请求, 固定速率时忽略'''
+
+
+class AIMDLimiter(TokenBucket):
+    '''加性增、乘性减(AIMD)的自适应限速器
+
+    每次请求成功后速率增加 increase / rate, 即持续成功时每秒约增加 increase;
+    被限流时速率乘以 decrease; 速率限制在 [min_rate, max_rate] 之间, min_rate 默认为初始速率的 1/10
+    '''
+
+    def __init__(self,
+                 rate: float,
+                 capacity: float = 1,
+                 min_rate: float | None = None,
+                 max_rate: float = 10,
+                 increase: float = 1,
+                 decrease: float = 0.5):
+        super().__init__(rate, capacity)
+        self.min_rate = rate / 10 if min_rate is None else min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.successes = 0
+        self.throttles = 0
+        self.__lock = threading.Lock()
+
+    def success(self):
+        with self.__lock:
+            self.successes += 1
+            self.set_rate(
+                min(self.max_rate, self.rate + self.increase / self.rate))
+
+    def throttled(self):
+        with self.__lock:
+            self.throttles += 1
+            self.set_rate(max(self.min_rate, self.rate * self.decrease))
+
+
+def is_rate_limited(result: dict):
+    '''API 返回的错误是否为请求过于频繁'''
+    error = result.get('error') or {}
+    message = f'{error.get("message", "")} {error.get("user_message", "")}'
+    return 'rate limit' in message.lower()
+
+
+def backoff(retry: int, base: float = 1.0, cap: float = 60.0):
+    '''指数退避等待时间(秒), 使用 full jitter 避免多个线程同时重试'''
+    return random.uniform(0, min(cap, base * 2**retry))
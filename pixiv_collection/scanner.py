@@ -0,0 +1,37 @@
+import hashlib
+import os
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def scan_files(path: str):
+    '''单次 os.scandir 遍历目录, 返回 {文件名: (大小, mtime_ns, inode)}, 忽略子目录'''
+    result = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                result[entry.name] = (stat.st_size, stat.st_mtime_ns,
+                                      stat.st_ino)
+    return result
+
+
+def file_stat(file_path: str):
+    '''获取单个文件的 (大小, mtime_ns, inode)'''
+    stat = os.stat(file_path)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def record_stat(file_data: dict):
+    '''文件记录中保存的 (大小, mtime_ns, inode)'''
+    return (file_data.get('filesize'), file_data.get('mtime_ns'),
+            file_data.get('inode'))
+
+
+def file_hash(file_path: str):
+    '''计算文件内容哈希'''
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
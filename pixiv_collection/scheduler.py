@@ -0,0 +1,79 @@
+import heapq
+from datetime import datetime
+
+DAY = 86400
+REFRESH_MIN_INTERVAL = DAY
+REFRESH_RATE_FLOOR = 0.1
+REFRESH_RATE_SMOOTHING = 0.5
+BOOKMARK_PAGE_MIN_HITS = 2
+
+
+def age_days(created_at: str, now: float):
+    try:
+        created = datetime.fromisoformat(created_at).timestamp()
+    except (TypeError, ValueError):
+        return 365
+    return max(1, (now - created) / DAY)
+
+
+def estimate_rate(old: dict | None, data: dict, now: float):
+    '''根据两次获取之间收藏数的变化估计每天新增收藏数, 使用指数平滑
+
+    old 为更新前的作品记录, 间隔不足一小时时沿用之前的估计
+    '''
+    if old is None:
+        return None
+    previous = old['data'].get('bookmark_rate')
+    days = (now - old['update']) / DAY
+    if days < 1 / 24:
+        return previous
+    observed = max(0, data['bookmark'] - old['data']['bookmark']) / days
+    if previous is None:
+        return round(observed, 4)
+    return round(
+        REFRESH_RATE_SMOOTHING * observed +
+        (1 - REFRESH_RATE_SMOOTHING) * previous, 4)
+
+
+def refresh_priority(record: dict, now: float):
+    '''作品信息的刷新优先级: 估计的每天收藏变化量 × 距上次获取的天数, 即估计的累计变化量
+
+    没有观测记录时以发布以来的平均每天收藏数作为估计, REFRESH_RATE_FLOOR 保证变化很少的作品最终也会被刷新
+    '''
+    data = record['data']
+    rate = data.get('bookmark_rate')
+    if rate is None:
+        rate = data['bookmark'] / age_days(data.get('created_at'), now)
+    return (rate + REFRESH_RATE_FLOOR) * (now - record['update']) / DAY
+
+
+class RefreshScheduler():
+    '''按刷新优先级排列待刷新作品的优先队列
+
+    只包含距上次获取超过 min_interval 秒的作品, 已通过其他途径刷新的作品用 discard 移除
+    '''
+
+    def __init__(self,
+                 images: dict,
+                 now: float,
+                 min_interval: float = REFRESH_MIN_INTERVAL):
+        self.__heap = [(-refresh_priority(record, now), image_id)
+                       for image_id, record in images.items()
+                       if now - record['update'] >= min_interval]
+        heapq.heapify(self.__heap)
+        self.due = {image_id for _, image_id in self.__heap}
+
+    def __len__(self):
+        return len(self.due)
+
+    def discard(self, image_id: str):
+        self.due.discard(image_id)
+
+    def pop(self):
+        '''取出优先级最高的作品 ID, 队列为空时返回 None'''
+        while self.__heap:
+            _, image_id = heapq.heappop(self.__heap)
+            if image_id in self.due:
+                self.due.discard(image_id)
+                return image_id
+        return None
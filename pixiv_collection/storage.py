@@ -0,0 +1,176 @@
+import json
+import os
+import sqlite3
+
+from scanner import file_hash
+
+TABLES = ('authors', 'images', 'tags', 'files')
+SQLITE_EXTS = ('.db', '.sqlite', '.sqlite3')
+
+
+def open_storage(file_path: str):
+    '''根据文件扩展名选择存储后端'''
+    if file_path.lower().endswith(SQLITE_EXTS):
+        return SQLiteStorage(file_path)
+    return JsonStorage(file_path)
+
+
+def replace_if_changed(tmp_path: str, file_path: str):
+    '''内容与 file_path 不同时用 tmp_path 原子替换, 相同时删除 tmp_path 并保留原文件, 返回是否替换'''
+    if (os.path.exists(file_path)
+            and os.path.getsize(file_path) == os.path.getsize(tmp_path)
+            and file_hash(file_path) == file_hash(tmp_path)):
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, file_path)
+    return True
+
+
+def empty_data():
+    data = {table: {} for table in TABLES}
+    data['watermarks'] = {}
+    return data
+
+
+class JsonStorage():
+    '''单个 JSON 文件存储, 每次保存全量重写为快照'''
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def load(self):
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        data.setdefault('watermarks', {})
+        return data
+
+    def save(self, data: dict, changes: dict | None = None):
+        '''保存数据, 忽略 changes 始终全量序列化, 内容未变动时不替换原文件, 返回是否写入'''
+        result = {
+            'authors':
+            dict(sorted(data['authors'].items(), key=lambda x: int(x[0]))),
+            'images':
+            dict(sorted(data['images'].items(), key=lambda x: int(x[0]))),
+            'tags':
+            data['tags'],
+            'files':
+            dict(
+                sorted(data['files'].items(),
+                       key=lambda x: x[1]['data']['id'] * 1000 + x[1]['data'][
+                           'part'])),
+            'watermarks':
+            data['watermarks'],
+        }
+        # 写入临时文件后原子重命名, 保存过程中中断不会损坏原文件
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        return replace_if_changed(tmp_path, self.file_path)
+
+
+class SQLiteStorage():
+    '''SQLite 存储, 每条记录一行, 按变动的键增量写入, 每次保存为一个事务'''
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.__db = None
+
+    def __connect(self):
+        if self.__db is None:
+            self.__db = sqlite3.connect(self.file_path)
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.executescript('''
+                CREATE TABLE IF NOT EXISTS authors (
+                    key TEXT PRIMARY KEY,
+                    updated INTEGER,
+                    record TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS images (
+                    key TEXT PRIMARY KEY,
+                    updated INTEGER,
+                    author_id INTEGER,
+                    record TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS tags (
+                    key TEXT PRIMARY KEY,
+                    updated INTEGER,
+                    record TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS files (
+                    key TEXT PRIMARY KEY,
+                    updated INTEGER,
+                    image_id INTEGER,
+                    part INTEGER,
+                    record TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS images_author ON images (author_id);
+                CREATE INDEX IF NOT EXISTS files_image ON files (image_id, part);
+            ''')
+        return self.__db
+
+    def __row(self, table: str, key: str, record: dict):
+        data = record['data']
+        dumped = json.dumps(record, ensure_ascii=False)
+        if table == 'images':
+            return (key, record.get('update'), data['author_id'], dumped)
+        if table == 'files':
+            return (key, record.get('update'), data['id'], data['part'],
+                    dumped)
+        return (key, record.get('update'), dumped)
+
+    def load(self):
+        if not os.path.exists(self.file_path):
+            raise FileNotFoundError(self.file_path)
+        db = self.__connect()
+        order = {
+            'authors': 'CAST(key AS INTEGER)',
+            'images': 'CAST(key AS INTEGER)',
+            'tags': 'rowid',
+            'files': 'image_id, part',
+        }
+        data = empty_data()
+        for table in TABLES:
+            for key, record in db.execute(
+                    f'SELECT key, record FROM {table} ORDER BY {order[table]}'):
+                data[table][key] = json.loads(record)
+        row = db.execute(
+            "SELECT value FROM meta WHERE key = 'watermarks'").fetchone()
+        if row:
+            data['watermarks'] = json.loads(row[0])
+        return data
+
+    def save(self, data: dict, changes: dict | None = None):
+        '''保存数据
+
+        changes 为 {表名: 变动的键集合}, 键存在于 data 中则写入, 否则删除;
+        changes 为 None 时全量重写
+        '''
+        db = self.__connect()
+        with db:
+            for table in TABLES:
+                records = data[table]
+                if changes is None:
+                    db.execute(f'DELETE FROM {table}')
+                    keys = records.keys()
+                else:
+                    keys = changes.get(table, ())
+                placeholders = ', '.join(
+                    '?' * (5 if table == 'files' else
+                           4 if table == 'images' else 3))
+                db.executemany(
+                    f'INSERT OR REPLACE INTO {table} VALUES ({placeholders})',
+                    [
+                        self.__row(table, key, records[key]) for key in keys
+                        if key in records
+                    ])
+                db.executemany(f'DELETE FROM {table} WHERE key = ?',
+                               [(key, ) for key in keys if key not in records])
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                       ('watermarks',
+                        json.dumps(data['watermarks'], ensure_ascii=False)))
+
+    def close(self):
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
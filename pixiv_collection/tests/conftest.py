@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 模块之间使用平级导入, 与直接运行脚本时一致
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+import pytest
+
+from cache import Cache, MemoryCache, SQLiteCache
+
+
+def test_incomplete_backend_fails_at_construction():
+
+    class GetOnlyCache(Cache):
+
+        def get(self, key: str):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyCache()
+    with pytest.raises(TypeError):
+        Cache()
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_backends_implement_interface(tmp_path, backend):
+    cache = (MemoryCache(max_entries=2) if backend == 'memory' else
+             SQLiteCache(str(tmp_path / 'cache.db'), max_entries=2))
+    cache.set('a', {'value': 1})
+    assert cache.get('a') == {'value': 1}
+    cache.delete('a')
+    assert cache.get('a') is None
+    assert cache.stats()['hits'] == 1
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from decoder import (ImageIntegrityError, decode_image, decode_png_reduced,
+                     verify_image, verify_png)
+
+WIDTH = 61
+HEIGHT = 47
+
+
+def noise(mode: str, seed: int = 0):
+    '''随机内容加上渐变, 使 PNG 编码器在不同行使用不同的过滤类型'''
+    rng = np.random.default_rng(seed)
+    channels = len(Image.new(mode, (1, 1)).getbands())
+    data = rng.integers(0, 256, (HEIGHT, WIDTH, channels), dtype=np.uint8)
+    data[::3] = np.arange(WIDTH, dtype=np.uint8)[:, None] * 4
+    return Image.fromarray(data[:, :, 0] if channels == 1 else data, mode)
+
+
+def palette_image(colors: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    img = Image.fromarray(
+        rng.integers(0, colors, (HEIGHT, WIDTH), dtype=np.uint8), 'P')
+    img.putpalette(rng.integers(0, 256, colors * 3, dtype=np.uint8).tobytes())
+    return img
+
+
+def save_png(tmp_path, name: str, img: Image.Image, **params):
+    path = str(tmp_path / f'{name}.png')
+    img.save(path, **params)
+    return path
+
+
+def expected(path: str, factor: int):
+    '''整图解码后 reduce 的结果, 调色板图转为 RGB / RGBA, 1 位图转为 L'''
+    with Image.open(path) as img:
+        img.load()
+        if img.mode == 'P':
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        elif img.mode == '1':
+            img = img.convert('L')
+        return img.reduce(factor)
+
+
+def make_images(tmp_path):
+    return {
+        'RGB': save_png(tmp_path, 'rgb', noise('RGB')),
+        'RGBA': save_png(tmp_path, 'rgba', noise('RGBA')),
+        'L': save_png(tmp_path, 'l', noise('L')),
+        'LA': save_png(tmp_path, 'la', noise('LA')),
+        'P': save_png(tmp_path, 'p', palette_image(256)),
+        'P;4': save_png(tmp_path, 'p4', palette_image(16), bits=4),
+        'P+tRNS': save_png(tmp_path,
+                           'ptrns',
+                           palette_image(16, 1),
+                           transparency=bytes(range(0, 160, 10))),
+        '1': save_png(tmp_path, '1', noise('L').convert('1')),
+    }
+
+
+@pytest.fixture(scope='module')
+def images(tmp_path_factory):
+    return make_images(tmp_path_factory.mktemp('png'))
+
+
+@pytest.mark.parametrize('name',
+                         ['RGB', 'RGBA', 'L', 'LA', 'P', 'P;4', 'P+tRNS', '1'])
+@pytest.mark.parametrize('factor, strips', [(2, 1), (3, 2), (4, 100)])
+def test_strip_decode_matches_full_reduce(images, name, factor, strips):
+    path = images[name]
+    # strips 为每个条带包含的 factor 行组数, 100 时整图一个条带
+    reduced = decode_png_reduced(path, factor, WIDTH * factor * strips)
+    full = expected(path, factor)
+    assert reduced is not None
+    assert reduced.mode == full.mode
+    assert reduced.size == full.size
+    assert reduced.tobytes() == full.tobytes()
+
+
+def test_decode_image_uses_strips_over_budget(images):
+    size, img = decode_image(images['RGB'], (20, 15), WIDTH * 4)
+    assert size == (WIDTH, HEIGHT)
+    assert img.tobytes() == expected(images['RGB'], 3).tobytes()
+
+
+def test_unsupported_format_returns_none(tmp_path):
+    img = Image.fromarray(
+        np.arange(WIDTH * HEIGHT, dtype=np.uint16).reshape(HEIGHT, WIDTH))
+    path = save_png(tmp_path, 'i16', img)
+    assert decode_png_reduced(path, 2, WIDTH * 4) is None
+
+
+def chunk_offset(data: bytes, chunk_type: bytes):
+    '''块类型字段在文件中的位置'''
+    return data.index(chunk_type)
+
+
+def test_truncated_file_is_rejected(images, tmp_path):
+    data = open(images['RGB'], 'rb').read()
+    path = str(tmp_path / 'truncated.png')
+    for size in (len(data) // 2, len(data) - 20):
+        with open(path, 'wb') as f:
+            f.write(data[:size])
+        with pytest.raises(ImageIntegrityError):
+            verify_png(path)
+        with pytest.raises(ImageIntegrityError):
+            decode_png_reduced(path, 2, WIDTH * 4)
+
+
+def test_corrupted_data_is_rejected(images, tmp_path):
+    data = bytearray(open(images['RGBA'], 'rb').read())
+    data[chunk_offset(data, b'IDAT') + 100] ^= 0x40
+    path = str(tmp_path / 'corrupted.png')
+    with open(path, 'wb') as f:
+        f.write(data)
+    with pytest.raises(ImageIntegrityError):
+        verify_png(path)
+    with pytest.raises(ImageIntegrityError):
+        decode_png_reduced(path, 2, WIDTH * 4)
+
+
+def test_missing_iend_is_rejected(images, tmp_path):
+    data = open(images['L'], 'rb').read()
+    path = str(tmp_path / 'no_iend.png')
+    with open(path, 'wb') as f:
+        f.write(data[:chunk_offset(data, b'IEND') - 4])
+    with pytest.raises(ImageIntegrityError):
+        verify_png(path)
+    with pytest.raises(ImageIntegrityError):
+        decode_png_reduced(path, 2, WIDTH * 4)
+
+
+def animated_gif(tmp_path):
+    path = str(tmp_path / 'animated.gif')
+    frames = [palette_image(256, seed) for seed in range(3)]
+    frames[0].save(path, save_all=True, append_images=frames[1:])
+    return path
+
+
+@pytest.mark.parametrize('name, budget', [('gif', None), ('gif', 100),
+                                          ('webp', None), ('webp', 100)])
+def test_verify_image_rejects_truncated(tmp_path, name, budget):
+    if name == 'gif':
+        path = animated_gif(tmp_path)
+    else:
+        path = str(tmp_path / 'image.webp')
+        noise('RGB').save(path)
+    # budget 为 100 时超过像素预算, 只检查文件结构
+    assert verify_image(path, budget) == (WIDTH, HEIGHT)
+    data = open(path, 'rb').read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) - 30])
+    with pytest.raises((ImageIntegrityError, OSError)):
+        verify_image(path, budget)
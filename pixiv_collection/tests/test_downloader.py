@@ -0,0 +1,107 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from downloader import IncompleteDownload, fetch_resumable
+
+PAYLOAD = os.urandom(200 * 1024 + 123)
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''模拟图片服务器, 支持 Range; drop_after 不为 None 时发送该字节数后断开连接'''
+
+    payload = PAYLOAD
+    drop_after = None
+    support_range = True
+    received = []
+
+    def do_GET(self):
+        self.received.append(dict(self.headers))
+        total = len(self.payload)
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and self.support_range:
+            start = int(match.group(1))
+            if start >= total:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{total}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{total - 1}/{total}')
+        else:
+            self.send_response(200)
+        body = self.payload[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.drop_after is not None:
+            body = body[:self.drop_after]
+            type(self).drop_after = None
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.drop_after = None
+    Handler.support_range = True
+    Handler.received = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/img/100_p0.png'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path: str):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_resume_after_dropped_connection(server, tmp_path):
+    part_path = str(tmp_path / '100_p0.png.part')
+    Handler.drop_after = 80 * 1024
+    with pytest.raises(requests.RequestException):
+        fetch_resumable(requests.request, server, part_path, chunk_size=4096)
+    # 断开前收到的数据保留在部分文件中
+    offset = os.path.getsize(part_path)
+    assert 0 < offset <= 80 * 1024
+    assert read(part_path) == PAYLOAD[:offset]
+
+    size = fetch_resumable(requests.request, server, part_path)
+    assert size == len(PAYLOAD)
+    assert read(part_path) == PAYLOAD
+    assert Handler.received[-1]['Range'] == f'bytes={offset}-'
+
+    # 部分文件已完整时服务器返回 416, 不再下载
+    assert fetch_resumable(requests.request, server, part_path) == len(PAYLOAD)
+    assert Handler.received[-1]['Range'] == f'bytes={len(PAYLOAD)}-'
+    assert read(part_path) == PAYLOAD
+
+
+def test_invalid_range_removes_part_file(server, tmp_path):
+    part_path = str(tmp_path / '100_p0.png.part')
+    with open(part_path, 'wb') as f:
+        f.write(PAYLOAD + b'extra')
+    with pytest.raises(IncompleteDownload):
+        fetch_resumable(requests.request, server, part_path)
+    assert not os.path.exists(part_path)
+
+
+def test_restart_when_range_is_not_supported(server, tmp_path):
+    part_path = str(tmp_path / '100_p0.png.part')
+    with open(part_path, 'wb') as f:
+        f.write(b'stale data')
+    Handler.support_range = False
+    assert fetch_resumable(requests.request, server,
+                           part_path) == len(PAYLOAD)
+    assert read(part_path) == PAYLOAD
@@ -0,0 +1,204 @@
+import json
+import os
+
+import pytest
+
+from collection import PixivCollection
+from journal import Journal, journal_path
+from storage import empty_data
+
+
+class FakeAPI():
+    '''只实现 update 使用的 illust_detail'''
+
+    def __init__(self):
+        self.calls = []
+
+    def illust_detail(self, illust_id):
+        self.calls.append(illust_id)
+        return {
+            'illust': {
+                'id': illust_id,
+                'title': f'title {illust_id}',
+                'caption': '',
+                'user': {
+                    'id': illust_id % 3 + 1,
+                    'name': 'user',
+                    'account': 'account',
+                },
+                'tags': [
+                    {
+                        'name': f'tag{illust_id % 2}',
+                        'translated_name': None,
+                    },
+                    {
+                        'name': 'common',
+                        'translated_name': None,
+                    },
+                ],
+                'create_date': '2023-01-01T00:00:00+09:00',
+                'sanity_level': 2,
+                'x_restrict': 0,
+                'total_bookmarks': 10,
+                'total_view': 100,
+            }
+        }
+
+
+def file_record(image_id: int):
+    return {
+        'update': 1,
+        'data': {
+            'id': image_id,
+            'part': 0,
+            'ext': 'png',
+            'size': [100, 100],
+            'dominant_color': '#000000',
+        },
+    }
+
+
+def make_collection(tmp_path, image_ids=(4, 5)):
+    data = empty_data()
+    for image_id in image_ids:
+        data['files'][f'{image_id}_p0.png'] = file_record(image_id)
+    data_path = str(tmp_path / 'c.json')
+    with open(data_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    return data_path
+
+
+def open_collection(data_path: str):
+    c = PixivCollection()
+    c.set_path({
+        'original': os.path.join(os.path.dirname(data_path), 'original'),
+        'preview': os.path.join(os.path.dirname(data_path), 'preview'),
+        'thumbnail': os.path.join(os.path.dirname(data_path), 'thumbnail'),
+    })
+    c.set_journal(flush_every=1)
+    c.read_data(data_path)
+    api = FakeAPI()
+    c._PixivCollection__api = api
+    c.set_rate_limit(1000, 10)
+    return c, api
+
+
+def read_lines(path: str):
+    with open(path, 'rb') as f:
+        return f.readlines()
+
+
+def test_group_is_replayed_atomically(tmp_path):
+    path = str(tmp_path / 'j.journal')
+    journal = Journal(path, flush_every=1)
+    journal.set('tags', 'a', {'data': 1})
+    with journal.group():
+        journal.set('images', '1', {'data': 1})
+        with journal.group():
+            journal.set('authors', '2', {'data': 2})
+        journal.set('tags', 'b', {'data': 3})
+    journal.close()
+    lines = read_lines(path)
+    assert len(lines) == 2
+    assert json.loads(lines[1])['op'] == 'group'
+
+    data = empty_data()
+    changes = Journal(path).replay(data)
+    assert set(data['images']) == {'1'}
+    assert set(data['authors']) == {'2'}
+    assert set(data['tags']) == {'a', 'b'}
+    assert changes['tags'] == {'a', 'b'}
+
+    # 写入组的过程中崩溃, 整组丢弃
+    with open(path, 'r+b') as f:
+        f.truncate(len(lines[0]) + len(lines[1]) // 2)
+    data = empty_data()
+    journal = Journal(path)
+    journal.replay(data)
+    assert journal.entries == 1
+    assert data['images'] == {} and data['authors'] == {}
+    assert set(data['tags']) == {'a'}
+    assert os.path.getsize(path) == len(lines[0])
+
+
+def test_illust_is_journaled_as_one_entry(tmp_path):
+    data_path = make_collection(tmp_path)
+    c, _ = open_collection(data_path)
+    assert c.update() == []
+    lines = read_lines(journal_path(data_path))
+    assert len(lines) == 2
+    assert {entry['table']
+            for entry in json.loads(lines[0])['entries']
+            } == {'images', 'authors', 'tags'}
+
+    # 第二个作品写入到一半时崩溃
+    with open(journal_path(data_path), 'r+b') as f:
+        f.truncate(len(lines[0]) + len(lines[1]) - 10)
+    c, _ = open_collection(data_path)
+    assert set(c.images) == {'4'}
+    assert set(c.authors) == {'2'}
+    c.export(str(tmp_path / 'images.json'))
+    with open(tmp_path / 'images.json', encoding='utf-8') as f:
+        assert [record['id'] for record in json.load(f)] == [4]
+
+
+def test_update_refetches_incomplete_illust(tmp_path):
+    data_path = make_collection(tmp_path)
+    # 旧版本逐条写入日志, 作品之后的作者与标签未写入磁盘
+    record = {
+        'update': 1,
+        'data': {
+            'id': 4,
+            'author_id': 2,
+            'title': 'title 4',
+            'caption': '',
+            'tags': ['tag0', 'common'],
+            'created_at': '2023-01-01T00:00:00+09:00',
+            'sanity_level': 2,
+            'x_restrict': 0,
+            'bookmark': 10,
+            'view': 100,
+        },
+    }
+    with open(journal_path(data_path), 'w', encoding='utf-8') as f:
+        f.write(
+            json.dumps({
+                'op': 'set',
+                'table': 'images',
+                'key': '4',
+                'record': record,
+            }) + '\n')
+    c, api = open_collection(data_path)
+    assert '4' in c.images and c.authors == {}
+
+    # 不完整的作品不导出, 而不是因缺少作者而出错
+    export_path = str(tmp_path / 'images.json')
+    c.export(export_path)
+    with open(export_path, encoding='utf-8') as f:
+        assert json.load(f) == []
+
+    assert c.update() == []
+    assert sorted(api.calls) == [4, 5]
+    c.export(export_path)
+    with open(export_path, encoding='utf-8') as f:
+        assert [record['id'] for record in json.load(f)] == [5, 4]
+
+    # 信息完整后不再重复获取
+    api.calls.clear()
+    assert c.update() == []
+    assert api.calls == []
+
+
+@pytest.mark.parametrize('checkpoint_every', [1, 2, 3])
+def test_checkpoint_waits_for_group(tmp_path, checkpoint_every):
+    data_path = make_collection(tmp_path)
+    c, _ = open_collection(data_path)
+    c.set_journal(flush_every=1, checkpoint_every=checkpoint_every)
+    c.update()
+    with open(data_path, encoding='utf-8') as f:
+        data = json.load(f)
+    # 快照中的每个作品都带有其作者与标签
+    for image in data['images'].values():
+        assert str(image['data']['author_id']) in data['authors']
+        assert all(tag in data['tags'] for tag in image['data']['tags'])
+    assert data['images']
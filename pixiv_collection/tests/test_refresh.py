@@ -0,0 +1,67 @@
+import collection
+from collection import PixivCollection
+
+THROTTLED = {'error': {'message': 'Rate Limit', 'user_message': ''}}
+
+
+class FakeAPI():
+    '''throttled 为 {作品 ID: 限流次数}, -1 表示一直返回限流错误'''
+
+    def __init__(self, throttled: dict):
+        self.throttled = dict(throttled)
+        self.calls = []
+
+    def illust_detail(self, illust_id):
+        self.calls.append(illust_id)
+        if self.throttled.get(illust_id, 0) != 0:
+            self.throttled[illust_id] -= 1
+            return THROTTLED
+        return {'illust': illust(illust_id)}
+
+
+def illust(illust_id: int):
+    return {
+        'id': illust_id,
+        'title': '',
+        'caption': '',
+        'user': {
+            'id': 1,
+            'name': 'user',
+            'account': 'account',
+        },
+        'tags': [],
+        'create_date': '2023-01-01T00:00:00+09:00',
+        'sanity_level': 2,
+        'x_restrict': 0,
+        'total_bookmarks': 100,
+        'total_view': 1000,
+    }
+
+
+def make_collection(monkeypatch, api: FakeAPI, image_ids):
+    monkeypatch.setattr(collection, 'WAIT_TIME', 0.001)
+    c = PixivCollection()
+    c._PixivCollection__api = api
+    c.set_rate_limit(1000, 10)
+    for i, image_id in enumerate(image_ids):
+        # 收藏数越多越优先刷新
+        data = c.convert_image_info(illust(image_id))
+        data['bookmark'] -= i
+        c.images[str(image_id)] = {'update': 1, 'data': data}
+    return c
+
+
+def test_retries_count_against_budget(monkeypatch):
+    api = FakeAPI({1: -1, 2: -1, 3: -1})
+    c = make_collection(monkeypatch, api, [1, 2, 3])
+    result = c.refresh(budget=5)
+    assert len(api.calls) == 5
+    assert result == {'calls': 5, 'refreshed': 0, 'remaining': 1}
+
+
+def test_budget_spent_on_retry_and_refresh(monkeypatch):
+    api = FakeAPI({1: 1})
+    c = make_collection(monkeypatch, api, [1, 2, 3, 4])
+    result = c.refresh(budget=4)
+    assert api.calls == [1, 1, 2, 3]
+    assert result == {'calls': 4, 'refreshed': 3, 'remaining': 1}
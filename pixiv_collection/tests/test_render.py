@@ -0,0 +1,60 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import collection
+from collection import PixivCollection
+
+CRASH = 'crash'
+
+
+def render(src, dst, size, quality, budget=None):
+    '''代替 render_webp, 文件名包含 CRASH 时模拟工作进程被系统终止'''
+    if CRASH in src:
+        os._exit(1)
+    with open(dst, 'wb') as f:
+        f.write(b'webp')
+    return {'decode': 0.0, 'encode': 0.0, 'bytes': 4}
+
+
+@pytest.fixture
+def pixiv(tmp_path, monkeypatch):
+    monkeypatch.setattr(collection, 'render_webp', render)
+    c = PixivCollection()
+    c.set_path({
+        kind: str(tmp_path / kind)
+        for kind in ('original', 'preview', 'thumbnail')
+    })
+    for image_id in range(1, 13):
+        name = f'{image_id}_p0.png' if image_id != 3 else f'3_p0.{CRASH}'
+        c.files[name] = {'update': 1, 'data': {'id': image_id, 'part': 0}}
+    return c, tmp_path / 'preview'
+
+
+def generated(preview):
+    return {
+        name.replace('_p', '_').split('.')[0]
+        for name in os.listdir(preview)
+    }
+
+
+ALL = {f'{image_id}_0' for image_id in range(1, 13)}
+
+
+def test_recreates_own_pool(pixiv):
+    c, preview = pixiv
+    failed = c.generate_preview(workers=2)
+    assert '3_0' in failed
+    # 进程池损坏时在途的文件记为失败, 之后的文件在新的进程池中生成
+    assert {f'{image_id}_0' for image_id in range(7, 13)} <= generated(preview)
+    assert set(failed) | generated(preview) == ALL
+
+
+def test_reports_remaining_with_external_executor(pixiv):
+    c, preview = pixiv
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        failed = c.generate_preview(executor=executor)
+    assert '3_0' in failed
+    assert '12_0' in failed
+    assert set(failed) | generated(preview) == ALL
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+from downloader import PART_SUFFIX
+from scanner import scan_files
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog 为可选依赖, 缺少时轮询目录
+    FileSystemEventHandler = object
+    Observer = None
+
+WATCH_DEBOUNCE = 2.0
+WATCH_POLL_INTERVAL = 5.0
+WATCH_EVENTS = ('created', 'modified', 'moved', 'deleted', 'closed')
+
+
+class _EventHandler(FileSystemEventHandler):
+
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in WATCH_EVENTS:
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', '')):
+            if path:
+                self.callback(os.path.basename(path))
+
+
+class DirectoryWatcher():
+    '''监视目录中文件的新增、修改与删除, 合并短时间内的连续变动
+
+    安装 watchdog 时订阅文件系统事件(Linux 下为 inotify), 否则每 poll_interval 秒比较一次目录快照;
+    文件在 debounce 秒内(轮询时至少一个轮询周期内)没有新的变动才视为写入完成;
+    忽略隐藏文件(包括下载临时目录)与未完成下载的 .part 文件
+    '''
+
+    def __init__(self,
+                 path: str,
+                 debounce: float = WATCH_DEBOUNCE,
+                 poll_interval: float = WATCH_POLL_INTERVAL,
+                 use_watchdog: bool = True):
+        self.path = path
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.polling = Observer is None or not use_watchdog
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__changed = threading.Event()
+        self.__observer = None
+        self.__snapshot = None
+
+    def __touch(self, name: str):
+        if name.startswith('.') or name.endswith(PART_SUFFIX):
+            return
+        with self.__lock:
+            self.__pending[name] = time.monotonic()
+        self.__changed.set()
+
+    def __poll(self):
+        current = scan_files(self.path)
+        for name in current.keys() | self.__snapshot.keys():
+            if current.get(name) != self.__snapshot.get(name):
+                self.__touch(name)
+        self.__snapshot = current
+
+    def start(self):
+        if self.polling:
+            self.__snapshot = scan_files(self.path)
+        else:
+            self.__observer = Observer()
+            self.__observer.schedule(_EventHandler(self.__touch),
+                                     self.path,
+                                     recursive=False)
+            self.__observer.start()
+
+    def stop(self):
+        if self.__observer is not None:
+            self.__observer.stop()
+            self.__observer.join()
+            self.__observer = None
+
+    def next_batch(self, timeout: float | None = None):
+        '''阻塞直到有文件写入完成, 返回文件名集合; 超过 timeout 秒仍没有时返回空集合'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        settle = max(self.debounce,
+                     self.poll_interval) if self.polling else self.debounce
+        while True:
+            if self.polling:
+                self.__poll()
+            with self.__lock:
+                now = time.monotonic()
+                ready = {
+                    name
+                    for name, last in self.__pending.items()
+                    if now - last >= settle
+                }
+                for name in ready:
+                    del self.__pending[name]
+                wait = min((settle - (now - last)
+                            for last in self.__pending.values()),
+                           default=None)
+                if not self.__pending:
+                    self.__changed.clear()
+            if ready:
+                return ready
+            if deadline is not None:
+                if now >= deadline:
+                    return set()
+                wait = min(wait, deadline - now) if wait else deadline - now
+            if self.polling:
+                time.sleep(min(wait or self.poll_interval, self.poll_interval))
+            elif self.__changed.is_set():
+                time.sleep(wait)
+            else:
+                # 没有待处理的变动, 等待新事件
+                self.__changed.wait(None if deadline is None else wait)